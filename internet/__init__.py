@@ -5,37 +5,78 @@ Basic operations for Internet.
 
 @Author Kingen
 """
+import contextlib
 import json
 import os
-import pickle
-from typing import Optional
-from urllib.parse import urlencode
+import re
+import threading
+import time
+from datetime import timedelta
+from typing import Optional, List, Tuple, Union, Callable
+from urllib.parse import urlencode, unquote
 
 import requests
 import unicodedata
 from bs4 import BeautifulSoup
-from requests import Response
+from requests import Response, Session
+from requests.cookies import RequestsCookieJar
 from urllib3.util import parse_url
 
 import common
+from internet.cache import CacheStore, MISSING, cache_key, open_cache, memory_cache
+from internet.parallel import flights
+from internet.parsers import Fragment, make_soup, resolve_parser
+from internet.pool import pools
+from internet.retry import RetryPolicy, default_retry_policy
+from internet.throttle import rate_limiter
 
 log = common.get_logger()
 base_headers = {
     'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) '
                   'Chrome/80.0.3987.132 Safari/537.36'
 }
+FOREVER = timedelta.max
+Freshness = Union[Optional[timedelta], Callable[[re.Match], Optional[timedelta]]]
 
 
 class BaseSite:
-    def __init__(self, home, name=None, headers=None, cache_dir: Optional[str] = None, encoding='utf-8'):
+    """
+    Basic site which is safe to be used by multiple threads.
+    Every thread has its own session while headers, cookies and the cache are shared.
+
+    Freshness of cached GETs is declared by routes in the attribute freshness, a list of
+    (pattern, ttl) matched in order against the unquoted path with query of a request.
+    The ttl is a timedelta, or None to never reuse the cache without revalidating, or a function of
+    the match returning either one. Requests matching no route are not cached.
+    """
+    freshness: List[Tuple[str, Freshness]] = []
+
+    def __init__(self, home, name=None, headers=None, cache_dir: Optional[str] = None, encoding='utf-8',
+                 rate: Optional[float] = None, burst=1, retry_policy: Optional[RetryPolicy] = None,
+                 parser='html.parser'):
+        """
+        @param rate: max requests per second to the host, shared by all sites of the host
+        @param burst: max count of requests sent at once if rate is specified
+        @param retry_policy: policy to retry failed requests, default_retry_policy if not specified
+        @param parser: backend to parse HTML, like 'html.parser', 'lxml' or 'html5lib'
+        """
         url = parse_url(home)
         self.__hostname = url.hostname
         self.__name = name or self.__hostname
         self.__root_uri = '%s://%s' % (url.scheme, url.netloc)
         self.__headers = {**base_headers, 'Host': url.hostname, **(headers or {})}
         self.__encoding = encoding
+        self.__parser = resolve_parser(parser)
         self.__cache_dir = cache_dir or os.path.join(os.getenv('TEMP'), self.__hostname)
-        self.__session = requests.session()
+        self.__cache = None
+        self.__cookies = RequestsCookieJar()
+        self.__local = threading.local()
+        self.__retry_policy = retry_policy or default_retry_policy
+        self.__routes = [(re.compile(pattern), ttl) for pattern, ttl in self.freshness]
+        self.__requests = 0
+        self.__requests_lock = threading.Lock()
+        if rate is not None:
+            rate_limiter.configure(self.__hostname, rate, burst)
 
     @property
     def hostname(self):
@@ -53,29 +94,115 @@ class BaseSite:
     def cache_dir(self):
         return self.__cache_dir
 
-    def get_soup(self, path, params=None, cache=False, retry=False):
-        return BeautifulSoup(self._do_get_cacheable(path, params, cache, retry), 'html.parser')
+    @property
+    def cache(self) -> CacheStore:
+        if self.__cache is None:
+            self.__cache = open_cache(self.__cache_dir)
+        return self.__cache
+
+    @property
+    def cookies(self):
+        return self.__cookies
+
+    @property
+    def retry_policy(self):
+        return self.__retry_policy
+
+    @property
+    def parser(self):
+        return self.__parser
+
+    @property
+    def request_count(self):
+        """
+        Count of requests sent by the site, including retries.
+        """
+        return self.__requests
+
+    @contextlib.contextmanager
+    def refreshing(self):
+        """
+        Ignores the freshness of cached GETs in the current thread within the context.
+        """
+        self.__local.refresh = True
+        try:
+            yield self
+        finally:
+            self.__local.refresh = False
+
+    def get_soup(self, path, params=None, cache=None, retry=False, parser=None,
+                 fragment: Optional[Fragment] = None) -> BeautifulSoup:
+        """
+        @param parser: backend to parse the page, the one of the site if not specified
+        @param fragment: simple selectors of the containers to parse only, see make_soup
+        """
+        return make_soup(self._do_get_cacheable(path, params, cache, retry), parser or self.__parser, fragment)
 
-    def get_json(self, path, params=None, cache=False, retry=False):
+    def get_json(self, path, params=None, cache=None, retry=False):
         return json.loads(self._do_get_cacheable(path, params, cache, retry))
 
-    def _do_get_cacheable(self, path, params=None, cache=False, retry=False):
-        if cache:
-            op = 'cache' if not retry else 'put'
-            filepath = self.cache_dir + path
-            if params:
-                filepath += '?' + urlencode(params)
-            return run_cacheable(filepath, lambda: self._do_get(path, params), op)
-        return self._do_get(path, params)
+    def get_freshness(self, key) -> Optional[timedelta]:
+        """
+        Finds the ttl of the cache of the key by routes in freshness.
+        """
+        key = unquote(key)
+        for pattern, ttl in self.__routes:
+            match = pattern.match(key)
+            if match is not None:
+                return ttl(match) if callable(ttl) else ttl
+        return None
+
+    def _do_get_cacheable(self, path, params=None, cache=None, retry=False):
+        """
+        Retrieves the content, from the cache if still fresh, otherwise revalidating the cached one with its
+        validators or refetching it.
+        @param cache: True to keep the cache forever, False to not use it, None to follow routes in freshness
+        @param retry: whether to ignore the freshness of the cache
+        """
+        key = cache_key(path, urlencode(params) if params else None)
+        if cache is None:
+            ttl = self.get_freshness(key)
+        else:
+            ttl = FOREVER if cache else None
+        entry = self.cache.get_entry(key)
+        retry = retry or getattr(self.__local, 'refresh', False)
+        if entry is not MISSING and ttl is not None and not retry:
+            if ttl == FOREVER or time.time() - entry.validated < ttl.total_seconds():
+                return self.__decode(entry.value)
+        # concurrent callers of the same key share one request
+        return self.__decode(flights.do((self.root_uri, key), lambda: self.__fetch(key, path, params, entry, ttl)))
+
+    def __fetch(self, key, path, params, entry, ttl: Optional[timedelta]) -> bytes:
+        headers = {}
+        if entry is not MISSING:
+            if entry.etag:
+                headers['If-None-Match'] = entry.etag
+            if entry.last_modified:
+                headers['If-Modified-Since'] = entry.last_modified
+        response = self._do_get_response(path, params, headers)
+        if response.status_code == 304 and entry is not MISSING:
+            log.debug('Not modified: %s%s', self.root_uri, key)
+            self.cache.touch(key)
+            return entry.value
+        if ttl is not None:
+            # raw bytes are compressed better and decoded when read
+            self.cache.put(key, response.content, response.headers.get('ETag'), response.headers.get('Last-Modified'))
+        return response.content
 
-    def _do_get(self, path, params=None):
+    def __decode(self, content) -> str:
+        if isinstance(content, str):
+            # decoded by earlier versions
+            return content
+        return content.decode(self.__encoding, errors='ignore')
+
+    def _do_get_response(self, path, params=None, headers=None) -> Response:
         if params and len(params) > 0:
             log.debug('Getting for %s%s?%s', self.root_uri, path, '&'.join(k + '=' + str(v) for k, v in params.items()))
         else:
             log.debug('Getting for %s%s', self.root_uri, path)
-        response = self.__session.get(self.root_uri + path, params=params, headers=self.__headers, timeout=(10, 30))
+        response = self.__send('GET', path, params, headers, timeout=(10, 30))
         response.raise_for_status()
-        return response.content.decode(self.__encoding, errors='ignore')
+        return response
 
     def format_json(self, data):
         if data is None:
@@ -95,10 +222,8 @@ class BaseSite:
     def _do_request_cacheable(self, path, method='POST', query=None, cache=False, retry=False, **kwargs) -> Response:
         if cache:
             op = 'cache' if not retry else 'put'
-            filepath = self.cache_dir + path
-            if query:
-                filepath += '?' + urlencode(query)
-            return run_cacheable(filepath, lambda: self._do_request(path, method, query, **kwargs), op)
+            key = cache_key(path, urlencode(query) if query else None)
+            return run_cacheable(self.cache, key, lambda: self._do_request(path, method, query, **kwargs), op)
         return self._do_request(path, method, query, **kwargs)
 
     def _do_request(self, path, method='POST', query=None, **kwargs) -> Response:
@@ -106,41 +231,54 @@ class BaseSite:
             log.debug('Requesting for %s%s?%s', self.root_uri, path, '&'.join(k + '=' + str(v) for k, v in query.items()))
         else:
             log.debug('Requesting for %s%s', self.root_uri, path)
-        return self.__session.request(method, self.root_uri + path, params=query, headers=self.__headers, **kwargs)
+        return self.__send(method, path, query, **kwargs)
+
+    def __send(self, method, path, params=None, headers=None, **kwargs) -> Response:
+        headers = {**self.__headers, **headers} if headers else self.__headers
+
+        def attempt():
+            rate_limiter.acquire(self.__hostname)
+            with self.__requests_lock:
+                self.__requests += 1
+            return self.__get_session().request(method, self.root_uri + path, params=params, headers=headers,
+                                                **kwargs)
 
+        return self.__retry_policy.run(self.__hostname, attempt, method)
 
-def run_cacheable(filepath, do_func, op='cache'):
+    def __get_session(self) -> Session:
+        session = getattr(self.__local, 'session', None)
+        if session is None:
+            session = pools.mount(requests.session(), self.__root_uri)
+            session.cookies = self.__cookies
+            self.__local.session = session
+        return session
+
+
+def run_cacheable(store: CacheStore, key, do_func, op='cache'):
     """
-    Retrieves data directly or from associated cache stored as file.
+    Retrieves data directly or from associated cache in the store.
     If op is 'cache', apply caching behaviour.
     If op is 'put', always invoke the actual function and cache the newer result.
     If op is 'evict', remove the cache if found and invoke the actual function
 
-    @param filepath: filepath to store associate cache
+    @param store: store of the cache
+    @param key: key of the cache, see cache_key()
     @param do_func: actual function to retrieve data
     @param op: option of 'cache', 'put' and 'evict'
     """
-    for ch in ['?']:
-        filepath = filepath.replace(ch, f'#{ord(ch)}')
-    filepath = filepath.rstrip('/') + '.pkl'
-
-    if op == 'cache' and os.path.exists(filepath):
-        log.debug(f'reading cache from {filepath}')
-        with open(filepath, 'rb') as fp:
-            return pickle.load(fp)
+    if op == 'cache':
+        data = store.get(key)
+        if data is not MISSING:
+            return data
 
-    if (op == 'cache' and not os.path.exists(filepath)) or op == 'put':
+    if op == 'cache' or op == 'put':
         data = do_func()
-        os.makedirs(os.path.dirname(filepath), exist_ok=True)
-        log.debug(f'writing cache to {filepath}')
-        with open(filepath, 'wb') as fp:
-            pickle.dump(data, fp)
+        store.put(key, data)
         return data
 
     if op == 'evict':
-        if os.path.exists(filepath):
-            log.debug(f'removing cache from {filepath}')
-            os.remove(filepath)
+        if store.remove(key):
+            log.debug(f'removed cache of {key}')
         return do_func()
 
     raise ValueError('cannot run with unknown operation: ' + op)
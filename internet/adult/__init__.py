@@ -6,19 +6,71 @@ Adult sites and resources.
 @Author Kingen
 """
 import abc
-from datetime import date
-from typing import List
+import re
+import threading
+from collections import namedtuple, deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+from typing import Any, Callable, Iterator, List, Optional, Tuple
 
+from bs4 import BeautifulSoup
+from requests import HTTPError
 from scrapy.exceptions import NotSupported
 from werkzeug.exceptions import HTTPException
 
+import common
 from common import YearMonth
-from internet import BaseSite, DuplicateError
+from internet import BaseSite, DuplicateError, FOREVER
+from internet.adult.index import WorkIndex, fingerprint
+
+log = common.get_logger()
 
 original_date = date(1900, 1, 1)
+DetailPage = namedtuple('DetailPage', ['path', 'params', 'fragment'], defaults=[None, None])
+
+
+def monthly_freshness(match: re.Match) -> Optional[timedelta]:
+    """
+    Freshness of listings of the month matched by groups 'year' and 'month'. Listings of past months never change.
+    """
+    ym = YearMonth(int(match['year']), int(match['month']))
+    return FOREVER if ym < YearMonth.now() else None
+
+
+def daily_freshness(days=7):
+    """
+    Freshness of listings of the date matched by group 'date', which never change after the days.
+    """
+
+    def freshness(match: re.Match) -> Optional[timedelta]:
+        return FOREVER if date.today() - date.fromisoformat(match['date']) >= timedelta(days=days) else None
+
+    return freshness
 
 
 class AdultSite(BaseSite):
+    # version of parsing details, to increase once parsing changes so that details of known works are parsed again
+    detail_version = 1
+
+    def __init__(self, home, name=None, **kwargs):
+        super().__init__(home, name, **kwargs)
+        self.__work_index = None
+        self.__work_index_lock = threading.Lock()
+
+    @property
+    def work_index(self) -> WorkIndex:
+        with self.__work_index_lock:
+            if self.__work_index is None:
+                self.__work_index = WorkIndex(self.cache_dir)
+            return self.__work_index
+
+    def work_index_stats(self) -> Optional[dict]:
+        """
+        @return: stats of the index of known works, None if the index is not used
+        """
+        with self.__work_index_lock:
+            return None if self.__work_index is None else self.__work_index.stats()
+
     @abc.abstractmethod
     def list_works(self) -> List[dict]:
         raise NotImplementedError
@@ -27,6 +79,56 @@ class AdultSite(BaseSite):
     def get_work_detail(self, wid) -> dict:
         raise NotImplementedError
 
+    def get_indexed_detail(self, wid, metadata: dict) -> dict:
+        """
+        Gets the detail of the work, skipped if the work is known with the same metadata in listings and its detail
+        was parsed by the current detail_version. Details of works whose metadata changed are refreshed instead of
+        read from the cache, while details parsed by an earlier version are parsed again, mostly from cached pages.
+        @param metadata: properties of the work in listings
+        """
+        fp, entry = fingerprint(metadata), self.work_index.get(wid)
+        if entry is not None and entry['fingerprint'] == fp and entry['version'] == self.detail_version:
+            self.work_index.count('known')
+            self.work_index.touch(wid)
+            if entry['duplicate']:
+                raise DuplicateError
+            return entry['detail']
+        try:
+            if entry is None:
+                self.work_index.count('new')
+                detail = self.get_work_detail(wid)
+            elif entry['fingerprint'] == fp:
+                self.work_index.count('reparsed')
+                detail = self.get_work_detail(wid)
+            else:
+                self.work_index.count('changed')
+                with self.refreshing():
+                    detail = self.get_work_detail(wid)
+        except DuplicateError:
+            self.work_index.put(wid, fp, self.detail_version, None, True)
+            raise
+        self.work_index.put(wid, fp, self.detail_version, detail)
+        return detail
+
+    def detail_page(self, wid) -> Optional[DetailPage]:
+        """
+        Returns the page of the work if its detail is parsed from the page only by parse_detail,
+        so that parsing can be separated from fetching, see internet.adult.pipeline.
+        """
+        return None
+
+    @classmethod
+    def parse_detail(cls, root_uri, wid, soup: BeautifulSoup) -> dict:
+        """
+        Parses the detail of the work from its page. It may be run in another process, so no request is allowed.
+        """
+        raise NotSupported
+
+    def _get_detail_by_page(self, wid) -> dict:
+        page = self.detail_page(wid)
+        return self.parse_detail(self.root_uri, wid, self.get_soup(page.path, page.params, True,
+                                                                   fragment=page.fragment))
+
     def refactor_work(self, work: dict) -> None:
         """
         Refactors properties of the work in-place.
@@ -38,7 +140,6 @@ class OrderedAdultSite(AdultSite):
     def list_works(self) -> List[dict]:
         return self.list_works_between(original_date, date.today())
 
-    @abc.abstractmethod
     def list_works_between(self, start: date, stop: date) -> List[dict]:
         """
         Retrieves works between the two dates.
@@ -46,13 +147,67 @@ class OrderedAdultSite(AdultSite):
         @param stop: end date(exclusive)
         @return works order by date descending if possible
         """
+        return list(self.iter_works_between(start, stop))
+
+    @abc.abstractmethod
+    def iter_works_between(self, start: date, stop: date) -> Iterator[dict]:
+        """
+        Yields works between the two dates as soon as they are retrieved, see list_works_between.
+        """
         raise NotImplementedError
 
+    def _seek_page(self, stop: date, fetch_page: Callable[[int], Any], oldest_date: Callable[[Any], Optional[date]],
+                   first=1) -> Tuple[int, Any]:
+        """
+        Finds the first page of a listing order by date descending which may contain works before stop,
+        by galloping then binary searching over pages, so pages of works after stop are skipped.
+        @param fetch_page: function to fetch the page by its number, whose HTTPError is raised for the first page
+            and taken as an empty page for others
+        @param oldest_date: function to get the date of the last work on the fetched page, None if the page is empty
+        @param first: number of the first page
+        @return: number of the page to start listing and the fetched page
+        """
+        pages, dates = {}, {}
+
+        def reached(page):
+            if page not in dates:
+                try:
+                    pages[page] = fetch_page(page)
+                except HTTPError:
+                    # pages probed beyond the end may be not found
+                    if page == first:
+                        raise
+                    pages[page] = None
+                dates[page] = None if pages[page] is None else oldest_date(pages[page])
+            return dates[page] is None or dates[page] < stop
+
+        if reached(first):
+            return first, pages[first]
+        low, step = first, 1
+        while not reached(first + step):
+            low = first + step
+            step *= 2
+        high = first + step
+        while high - low > 1:
+            mid = (low + high) // 2
+            if reached(mid):
+                high = mid
+            else:
+                low = mid
+        # start from the last non-empty page if no work is before stop
+        page = high if dates[high] is not None else low
+        log.info('Seek page %d of %s for works before %s in %d requests', page, self.name, stop, len(dates))
+        return page, pages[page]
+
 
 class MonthlyAdultSite(AdultSite):
-    def __init__(self, home, start_month: YearMonth, **kwargs):
+    def __init__(self, home, start_month: YearMonth, workers=1, **kwargs):
+        """
+        @param workers: max count of months and details fetched at once
+        """
         super().__init__(home, **kwargs)
         self.__start_month = start_month
+        self.__workers = workers
 
     @property
     def start_month(self):
@@ -63,22 +218,69 @@ class MonthlyAdultSite(AdultSite):
 
     def list_works_between(self, start: YearMonth, stop: YearMonth) -> List[dict]:
         """
-        Retrieves works between the two months.
+        Retrieves works between the two months, order by month descending.
         @param start: start month(inclusive)
         @param stop: end month(exclusive), not after current month
         """
-        works, ym = [], stop.plus_months(-1)
+        return list(self.iter_works_between(start, stop))
+
+    def iter_works_between(self, start: YearMonth, stop: YearMonth) -> Iterator[dict]:
+        """
+        Yields works between the two months as soon as they are retrieved, see list_works_between.
+        """
+        for ym, works in self.iter_monthly_works(start, stop):
+            yield from works
+
+    def iter_monthly_works(self, start: YearMonth, stop: YearMonth) -> Iterator[Tuple[YearMonth, List[dict]]]:
+        """
+        Yields every month between the two months with its works, order by month descending.
+        """
+        months, ym = [], stop.plus_months(-1)
         while ym >= self.__start_month and ym >= start:
-            for work in self._list_monthly(ym):
-                try:
-                    work.update(self.get_work_detail(work['wid']))
-                except DuplicateError:
-                    continue
-                except (HTTPException, NotSupported):
-                    pass
-                works.append(work)
+            months.append(ym)
             ym = ym.plus_months(-1)
-        return works
+        if self.__workers <= 1:
+            for ym in months:
+                yield ym, [work for work in self._list_monthly(ym)
+                           if self.__update_work(work, lambda: self.get_indexed_detail(work['wid'], dict(work)))]
+            return
+
+        with ThreadPoolExecutor(self.__workers, thread_name_prefix=self.hostname) as executor:
+            try:
+                # list a bounded count of months ahead and keep a bounded count of details in memory
+                months, monthly, groups, pending = deque(months), deque(), deque(), 0
+                while len(months) > 0 or len(monthly) > 0:
+                    while len(months) > 0 and len(monthly) < self.__workers:
+                        ym = months.popleft()
+                        monthly.append((ym, executor.submit(self._list_monthly, ym)))
+                    ym, listing = monthly.popleft()
+                    group = [(work, executor.submit(self.get_indexed_detail, work['wid'], dict(work)))
+                             for work in listing.result()]
+                    groups.append((ym, group))
+                    pending += len(group)
+                    while len(groups) > 0 and pending > self.__workers * 4:
+                        ym, group = groups.popleft()
+                        pending -= len(group)
+                        yield ym, [work for work, detail in group if self.__update_work(work, detail.result)]
+                while len(groups) > 0:
+                    ym, group = groups.popleft()
+                    yield ym, [work for work, detail in group if self.__update_work(work, detail.result)]
+            except BaseException:
+                executor.shutdown(cancel_futures=True)
+                raise
+
+    @staticmethod
+    def __update_work(work: dict, get_detail: Callable[[], dict]) -> bool:
+        """
+        @return: whether the work is kept
+        """
+        try:
+            work.update(get_detail())
+        except DuplicateError:
+            return False
+        except (HTTPException, NotSupported):
+            pass
+        return True
 
     @abc.abstractmethod
     def _list_monthly(self, ym: YearMonth) -> List[dict]:
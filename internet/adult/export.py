@@ -5,18 +5,20 @@ Persist data.
 
 @Author Kingen
 """
+import itertools
 import json
 import os
 from datetime import timedelta, time as time_cls, datetime, date
 from re import Pattern
-from typing import List
+from typing import Any, Callable, Iterable, Iterator, List, Tuple
 
 from requests import Response
+from requests.exceptions import RequestException
 
 import common
 from common import ComplexEncoder, YearMonth
 from internet import BaseSite
-from internet.adult import original_date, OrderedAdultSite, MonthlyAdultSite
+from internet.adult import original_date, AdultSite, OrderedAdultSite, MonthlyAdultSite
 
 log = common.get_logger()
 
@@ -58,29 +60,10 @@ def export_data(data_file, export_func):
     for i in range(len(records)):
         if i >= len(exports) or exports[i]['recordAt'] != records[i]['updateAt']:
             changed = True
-            updated, created, ignored, errors = 0, 0, 0, []
+            export = new_export(records[i]['updateAt'])
             for datum in records[i]['data']:
-                datum = json.loads(json.dumps(datum, ensure_ascii=False, cls=ComplexEncoder))
-                resp = export_func(datum)
-                if resp.status_code == 200:
-                    updated += 1
-                elif resp.status_code == 201:
-                    created += 1
-                elif resp.status_code == 204:
-                    ignored += 1
-                elif resp.status_code == 409:
-                    errors.append({'error': json.loads(resp.content.decode('utf-8')), 'source': datum})
-                else:
-                    errors.append({'error': resp.content.decode('utf-8'), 'source': datum})
-            export = {
-                'recordAt': records[i]['updateAt'],
-                'updateAt': datetime.now(),
-                'updated': updated,
-                'created': created,
-                'ignored': ignored,
-                'errorsCount': len(errors),
-                'errors': errors
-            }
+                export_datum(datum, export_func, export)
+            finish_export(export)
             if i >= len(exports):
                 exports.append(export)
             else:
@@ -90,6 +73,112 @@ def export_data(data_file, export_func):
             json.dump(exports, fp, ensure_ascii=False, cls=ComplexEncoder)
 
 
+def new_export(record_at) -> dict:
+    return {
+        'recordAt': record_at,
+        'updateAt': None,
+        'updated': 0,
+        'created': 0,
+        'ignored': 0,
+        'errorsCount': 0,
+        'errors': []
+    }
+
+
+def export_datum(datum, export_func, export: dict) -> None:
+    """
+    Exports the datum by the function and counts the result in the export.
+    """
+    datum = json.loads(json.dumps(datum, ensure_ascii=False, cls=ComplexEncoder))
+    resp = export_func(datum)
+    if resp.status_code == 200:
+        export['updated'] += 1
+    elif resp.status_code == 201:
+        export['created'] += 1
+    elif resp.status_code == 204:
+        export['ignored'] += 1
+    elif resp.status_code == 409:
+        export['errors'].append({'error': json.loads(resp.content.decode('utf-8')), 'source': datum})
+    else:
+        export['errors'].append({'error': resp.content.decode('utf-8'), 'source': datum})
+
+
+def finish_export(export: dict) -> None:
+    export['updateAt'] = datetime.now()
+    export['errorsCount'] = len(export['errors'])
+
+
+def save_export(data_file, index, export: dict) -> None:
+    """
+    Saves the export of the record at the index if all previous records are exported,
+    otherwise the record is left to export_data.
+    """
+    filename, ext = os.path.splitext(data_file)
+    export_file = filename + '-export' + ext
+    exports: List[dict] = []
+    if os.path.exists(export_file):
+        with open(export_file, 'r', encoding='utf-8') as fp:
+            exports = json.load(fp)
+    if len(exports) != index:
+        log.warning('Previous records of %s are not exported yet', data_file)
+        return
+    exports.append(export)
+    with open(export_file, 'w', encoding='utf-8') as fp:
+        json.dump(exports, fp, ensure_ascii=False, cls=ComplexEncoder)
+
+
+def refactor_works(works: Iterable[dict], site: AdultSite) -> Iterator[dict]:
+    for work in works:
+        work = work.copy()
+        site.refactor_work(work)
+        yield work
+
+
+def export_works(works: Iterable[dict], export_func, export: dict) -> Iterator[dict]:
+    """
+    Exports works as they pass. Once the export fails to connect, the remaining works pass without exporting,
+    and the export is marked aborted and left to export_data.
+    """
+    for work in works:
+        if not export.get('aborted'):
+            try:
+                export_datum(work, export_func, export)
+            except RequestException as ex:
+                log.warning('Stop exporting works as they are retrieved, left to export_data: %s', ex)
+                export['aborted'] = True
+        yield work
+
+
+def append_record(filepath, records: List[dict], record: dict, data: Iterable[dict]) -> int:
+    """
+    Writes the records followed by the new record, whose data are written one by one as they come.
+    The file is replaced only if any datum is written.
+    @return: count of written data
+    """
+    tmp_path, count = filepath + '.tmp', 0
+    try:
+        with open(tmp_path, 'w', encoding='utf-8') as fp:
+            fp.write('[')
+            for previous in records:
+                json.dump(previous, fp, ensure_ascii=False, cls=ComplexEncoder)
+                fp.write(', ')
+            fp.write(json.dumps(record, ensure_ascii=False, cls=ComplexEncoder)[:-1] + ', "data": [')
+            for datum in data:
+                if count > 0:
+                    fp.write(', ')
+                json.dump(datum, fp, ensure_ascii=False, cls=ComplexEncoder)
+                count += 1
+            fp.write('], "count": %d}]' % count)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    if count == 0:
+        os.remove(tmp_path)
+    else:
+        os.replace(tmp_path, filepath)
+    return count
+
+
 def import_data(filepath, list_func, refactor_func, interval=timedelta(days=14)) -> None:
     """
     Imports the result of the functions to destination json file.
@@ -117,9 +206,99 @@ def import_data(filepath, list_func, refactor_func, interval=timedelta(days=14))
             json.dump(records, fp, ensure_ascii=False, cls=ComplexEncoder)
 
 
-def import_ordered_works(filepath, site: OrderedAdultSite, interval=timedelta(days=1)) -> None:
+class Checkpoint:
+    """
+    Progress of a crawl of works, split into units like days or months which are crawled in descending order.
+    Every completed unit is appended to a file next to the data file as a line of json, so an interrupted crawl
+    resumes from the last completed unit instead of the beginning.
+    """
+
+    def __init__(self, filepath, start, stop, parse_unit: Callable[[str], Any]):
+        """
+        @param start: start unit(inclusive) of the crawl
+        @param stop: stop unit(exclusive) of the crawl, replaced by the one of the checkpoint if resuming
+        @param parse_unit: function to parse a unit from a string
+        """
+        self.__path = filepath + '.checkpoint'
+        self.__stop, self.__resume_at, self.__works = stop, None, []
+        if os.path.exists(self.__path):
+            with open(self.__path, 'r', encoding='utf-8') as fp:
+                lines = fp.readlines()
+            header = json.loads(lines[0]) if len(lines) > 0 else {}
+            if header.get('start') == str(start):
+                self.__stop = parse_unit(header['stop'])
+                for line in lines[1:]:
+                    try:
+                        progress = json.loads(line)
+                    except ValueError:
+                        # the line is broken by the interruption
+                        break
+                    unit = parse_unit(progress['unit'])
+                    self.__resume_at = unit if self.__resume_at is None else min(self.__resume_at, unit)
+                    self.__works.extend(progress['data'])
+                log.info('Resume the crawl of %s from %s with %d works', filepath, self.__resume_at,
+                         len(self.__works))
+        if self.__resume_at is None:
+            with open(self.__path, 'w', encoding='utf-8') as fp:
+                fp.write(json.dumps({'start': start, 'stop': self.__stop}, cls=ComplexEncoder) + '\n')
+
+    @property
+    def stop(self):
+        return self.__stop
+
+    @property
+    def resume_at(self):
+        """
+        Unit to resume the crawl before(exclusive).
+        """
+        return self.__stop if self.__resume_at is None else self.__resume_at
+
+    @property
+    def works(self) -> List[dict]:
+        """
+        Works of completed units.
+        """
+        return self.__works
+
+    def track(self, units: Iterable[Tuple[Any, List[dict]]]) -> Iterator[dict]:
+        """
+        Yields works of the units, and saves every unit once all of its works are consumed.
+        """
+        for unit, works in units:
+            yield from works
+            with open(self.__path, 'a', encoding='utf-8') as fp:
+                fp.write(json.dumps({'unit': unit, 'data': works}, ensure_ascii=False, cls=ComplexEncoder) + '\n')
+
+    def remove(self):
+        if os.path.exists(self.__path):
+            os.remove(self.__path)
+
+
+def group_by_date(works: Iterable[dict]) -> Iterator[Tuple[date, List[dict]]]:
+    """
+    Groups works ordered by release date descending to units of days.
+    A day is yielded once a work of an earlier day comes, or the works are exhausted.
+    """
+    day, group = None, []
+    for work in works:
+        if len(group) > 0 and work['releaseDate'] != day:
+            yield day, group
+            group = []
+        day = work['releaseDate']
+        group.append(work)
+    if len(group) > 0:
+        yield day, group
+
+
+def refactor_units(units: Iterable[Tuple[Any, List[dict]]], site: AdultSite) -> Iterator[Tuple[Any, List[dict]]]:
+    for unit, works in units:
+        yield unit, list(refactor_works(works, site))
+
+
+def import_ordered_works(filepath, site: OrderedAdultSite, interval=timedelta(days=1), export_func=None) -> None:
     """
     Imports in-order works of the given site to destination json file.
+    @param export_func: function to export works as soon as they are retrieved, exported by export_data later if None
     """
     os.makedirs(os.path.dirname(filepath), exist_ok=True)
     start, stop, records = original_date, date.today(), []
@@ -129,25 +308,16 @@ def import_ordered_works(filepath, site: OrderedAdultSite, interval=timedelta(da
         start = date.fromisoformat(records[-1]['stop'])
 
     if stop - start >= interval:
-        works = [x.copy() for x in site.list_works_between(start, stop)]
-        if len(works) == 0:
-            return
-        for work in works:
-            site.refactor_work(work)
-        records.append({
-            'updateAt': datetime.now(),
-            'start': start,
-            'stop': stop,
-            'count': len(works),
-            'data': works
-        })
-        with open(filepath, 'w', encoding='utf-8') as fp:
-            json.dump(records, fp, ensure_ascii=False, cls=ComplexEncoder)
+        checkpoint = Checkpoint(filepath, start, stop, date.fromisoformat)
+        record = {'updateAt': datetime.now(), 'start': start, 'stop': checkpoint.stop}
+        units = group_by_date(site.iter_works_between(start, checkpoint.resume_at))
+        import_works(filepath, records, record, units, site, checkpoint, export_func)
 
 
-def import_monthly_works(filepath, site: MonthlyAdultSite) -> None:
+def import_monthly_works(filepath, site: MonthlyAdultSite, export_func=None) -> None:
     """
     Imports monthly works of the given site to destination json file.
+    @param export_func: function to export works as soon as they are retrieved, exported by export_data later if None
     """
     os.makedirs(os.path.dirname(filepath), exist_ok=True)
     start, stop, records = site.start_month, YearMonth.now(), []
@@ -157,20 +327,30 @@ def import_monthly_works(filepath, site: MonthlyAdultSite) -> None:
         start = YearMonth.parse(records[-1]['stop'])
 
     if start < stop:
-        works = [x.copy() for x in site.list_works_between(start, stop)]
-        if len(works) == 0:
-            return
-        for work in works:
-            site.refactor_work(work)
-        records.append({
-            'updateAt': datetime.now(),
-            'start': str(start),
-            'stop': str(stop),
-            'count': len(works),
-            'data': works
-        })
-        with open(filepath, 'w', encoding='utf-8') as fp:
-            json.dump(records, fp, ensure_ascii=False, cls=ComplexEncoder)
+        checkpoint = Checkpoint(filepath, start, stop, YearMonth.parse)
+        record = {'updateAt': datetime.now(), 'start': str(start), 'stop': str(checkpoint.stop)}
+        units = site.iter_monthly_works(start, checkpoint.resume_at)
+        import_works(filepath, records, record, units, site, checkpoint, export_func)
+
+
+def import_works(filepath, records: List[dict], record: dict, units: Iterable[Tuple[Any, List[dict]]],
+                 site: AdultSite, checkpoint: Checkpoint, export_func=None) -> None:
+    """
+    Streams units of works through refactoring, exporting and persisting as a new record,
+    following works restored from the checkpoint.
+    Restored works are exported again along with new ones, since the interrupted run may have failed to export them
+    or not exported them at all, so the export covers the whole record.
+    """
+    works = itertools.chain(checkpoint.works, checkpoint.track(refactor_units(units, site)))
+    export = None
+    if export_func is not None:
+        export = new_export(record['updateAt'])
+        works = export_works(works, export_func, export)
+    count = append_record(filepath, records, record, works)
+    checkpoint.remove()
+    if count > 0 and export is not None and not export.get('aborted'):
+        finish_export(export)
+        save_export(filepath, len(records), export)
 
 
 def validate_works(works: List[dict], sn_regexp: Pattern, ordered=True) -> None:
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+"""
+Index of known works of a site, to skip details of works unchanged since the last crawl.
+
+@Author Kingen
+"""
+import hashlib
+import json
+import os
+import threading
+from typing import Optional
+
+import common
+from common import ComplexEncoder
+from internet.cache import MISSING, open_store
+
+log = common.get_logger()
+
+
+def fingerprint(metadata: dict) -> str:
+    """
+    Digests metadata of a work in listings.
+    """
+    content = json.dumps(metadata, ensure_ascii=False, sort_keys=True, cls=ComplexEncoder)
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+
+class WorkIndex:
+    """
+    Maps wid of every known work to the fingerprint of its metadata in listings, the version of parsing its detail,
+    the time last seen and its detail. Entries are kept in a store under the cache directory of the site.
+    """
+
+    def __init__(self, cache_dir):
+        self.__store = open_store(os.path.join(cache_dir, 'index'))
+        self.__lock = threading.Lock()
+        self.__stats = {'known': 0, 'new': 0, 'changed': 0, 'reparsed': 0}
+
+    def get(self, wid) -> Optional[dict]:
+        """
+        @return: the entry with fingerprint, version, seenAt, detail and duplicate, None if unknown
+        """
+        entry = self.__store.get_entry(wid)
+        return None if entry is MISSING else {'version': 1, **entry.value, 'seenAt': entry.validated}
+
+    def put(self, wid, fp: str, version: int, detail: Optional[dict], duplicate=False) -> None:
+        self.__store.put(wid, {'fingerprint': fp, 'version': version, 'detail': detail, 'duplicate': duplicate})
+
+    def touch(self, wid) -> None:
+        """
+        Marks the known work as seen just now, without rewriting its entry.
+        """
+        self.__store.touch(wid)
+
+    def count(self, state: str) -> None:
+        with self.__lock:
+            self.__stats[state] += 1
+
+    def stats(self) -> dict:
+        with self.__lock:
+            return self.__stats.copy()
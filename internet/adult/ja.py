@@ -6,14 +6,18 @@ Japanese adult producers.
 @Author Kingen
 """
 import argparse
+import functools
+import json
+import math
 import os
 import re
+import threading
 import time
 from abc import ABC
-from collections import OrderedDict
-from datetime import date, datetime, timedelta
-from queue import Queue
-from typing import List
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime
+from typing import Dict, Iterator, List, Optional, Set, Tuple
 from urllib.parse import urlparse, parse_qs, unquote, urljoin
 
 import execjs
@@ -25,8 +29,12 @@ from werkzeug.exceptions import NotFound, BadGateway
 
 import common
 from common import OptionalValue, YearMonth
-from internet import normalize_str, DuplicateError
-from internet.adult import ActorSite, AdultSite, OrderedAdultSite, MonthlyAdultSite, export
+from internet import normalize_str, DuplicateError, pools, rate_limiter, default_retry_policy, memory_cache, \
+    flights, make_soup
+from internet.adult import ActorSite, AdultSite, OrderedAdultSite, MonthlyAdultSite, DetailPage, export, \
+    monthly_freshness, daily_freshness
+from internet.extract import Extractor, Field, not_blank
+from internet.parallel import Scheduler, paginate, prefetch
 
 log = common.get_logger()
 
@@ -62,7 +70,14 @@ class JaActorSite(ActorSite, ABC):
 class BaseWillProducer(OrderedAdultSite):
     sn_regexp = re.compile('([A-Z]+)(\\d{3})')
 
-    def list_works_between(self, start: date, stop: date) -> List[dict]:
+    def __init__(self, home, name=None, workers=8, **kwargs):
+        """
+        @param workers: max count of listings and probes requested at once
+        """
+        super().__init__(home, name, **kwargs)
+        self.__workers = workers
+
+    def iter_works_between(self, start: date, stop: date) -> Iterator[dict]:
         available_dates = []
         for item in self.get_soup('/works/date').select('.p-accordion a.item'):
             available_dates.append(date.fromisoformat(item['href'].strip('/').split('/')[-1]))
@@ -70,54 +85,97 @@ class BaseWillProducer(OrderedAdultSite):
         if stop <= start_date:
             raise ValueError('cannot retrieve works too early')
         if start >= start_date:
-            works = self.__list_works_among(available_dates, start, stop)
+            yield from self.__iter_works_among(available_dates, start, stop)
         else:
             works = self.__list_works_all(available_dates, start, stop)
-        return sorted(works, key=lambda x: x['releaseDate'], reverse=True)
+            # works are probed out of order
+            yield from sorted(works, key=lambda x: x['releaseDate'], reverse=True)
 
-    def __list_works_among(self, dates, start, stop):
-        works = []
-        for day in dates:
+    def __iter_works_among(self, dates, start, stop):
+        for day in sorted(dates, reverse=True):
             if start <= day < stop:
                 for idx in self.__list_work_indices_by_date(day):
-                    try:
-                        work = self.get_work_detail(idx['wid'])
-                    except NotFound:
-                        work = self.get_work_detail(idx['wid'], retry=True)
-                    works.append({**idx, **work})
-        return works
+                    yield {**idx, **self.__get_listed_detail(idx)}
 
     def __list_works_all(self, dates, start, stop):
-        used, pending, works = set(), Queue(), []
-        for day in dates:
-            pending.put(day)
-        prefix_ids: dict = {}
-        while not pending.empty():
-            day = pending.get()
-            if day in used or day < start or day >= stop:
-                continue
-            used.add(day)
-            for idx in self.__list_work_indices_by_date(day):
-                try:
-                    work = self.get_work_detail(idx['wid'])
-                except NotFound:
-                    work = self.get_work_detail(idx['wid'], retry=True)
-                work['cover'] = idx['cover']
-                works.append(work)
-
-                match = self.sn_regexp.fullmatch(idx['wid'])
-                prefix, num = match.group(1), int(match.group(2))
-                last, notfound = prefix_ids.get(prefix, (0, 0))
-                if num <= last:
-                    continue
-                for i in range(last + 1, num):
-                    try:
-                        pending.put(self.get_work_detail("%s%03d" % (prefix, i))['releaseDate'])
-                    except NotFound:
-                        notfound += 1
-                prefix_ids[prefix] = (num, notfound)
+        """
+        Lists works of all dates, including dates not available but found by probing missing serial numbers
+        between listed ones. Probes are sent concurrently, and numbers not found before are skipped.
+        Works are only returned when all rounds of probing finish, so the crawl is not saved by checkpoints by days,
+        but listings and details are cached, and numbers not found are saved even if the crawl is interrupted.
+        """
+        dead = self.__load_dead_serials()
+        used, pending, works = set(), set(dates), []
+        known: Dict[str, Set[int]] = defaultdict(set)
+        try:
+            with ThreadPoolExecutor(self.__workers, thread_name_prefix=self.hostname) as executor:
+                while len(pending) > 0:
+                    days = sorted((x for x in pending if x not in used and start <= x < stop), reverse=True)
+                    pending.clear()
+                    used.update(days)
+                    indices = [idx for day_indices in executor.map(self.__list_work_indices_by_date, days)
+                               for idx in day_indices]
+                    for idx, work in zip(indices, executor.map(self.__get_listed_detail, indices)):
+                        work['cover'] = idx['cover']
+                        works.append(work)
+                        match = self.sn_regexp.fullmatch(idx['wid'])
+                        known[match.group(1)].add(int(match.group(2)))
+
+                    probes = [(prefix, i) for prefix, nums in known.items() for i in range(1, max(nums))
+                              if i not in nums and i not in dead[prefix]]
+                    notfound = 0
+                    for (prefix, i), release_date in zip(probes, executor.map(self.__probe, probes)):
+                        known[prefix].add(i)
+                        if release_date is None:
+                            dead[prefix].add(i)
+                            notfound += 1
+                        elif release_date not in used:
+                            pending.add(release_date)
+                    if len(probes) > 0:
+                        log.info('Probed %d missing serial numbers of %s: %d not found, %d new dates', len(probes),
+                                 self.name, notfound, len(pending))
+        finally:
+            self.__save_dead_serials(dead)
         return works
 
+    def __get_listed_detail(self, idx: dict) -> dict:
+        try:
+            return self.get_indexed_detail(idx['wid'], idx)
+        except NotFound:
+            return self.get_work_detail(idx['wid'], retry=True)
+
+    def __probe(self, probe: Tuple[str, int]) -> Optional[date]:
+        try:
+            return self.get_work_detail("%s%03d" % probe)['releaseDate']
+        except NotFound:
+            return None
+
+    def __load_dead_serials(self) -> Dict[str, Set[int]]:
+        """
+        Serial numbers not found by earlier probes, saved as ranges by prefix.
+        """
+        dead = defaultdict(set)
+        path = os.path.join(self.cache_dir, 'dead-serials.json')
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as fp:
+                for prefix, ranges in json.load(fp).items():
+                    for low, high in ranges:
+                        dead[prefix].update(range(low, high + 1))
+        return dead
+
+    def __save_dead_serials(self, dead: Dict[str, Set[int]]):
+        ranges = {}
+        for prefix, nums in dead.items():
+            ranges[prefix] = []
+            for num in sorted(nums):
+                if len(ranges[prefix]) > 0 and ranges[prefix][-1][1] == num - 1:
+                    ranges[prefix][-1][1] = num
+                else:
+                    ranges[prefix].append([num, num])
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with open(os.path.join(self.cache_dir, 'dead-serials.json'), 'w', encoding='utf-8') as fp:
+            json.dump(ranges, fp)
+
     def __list_work_indices_by_date(self, day: date):
         soup = self.get_soup(f'/works/list/date/{day}', cache=True)
         cards = soup.select('.swiper-slide .c-card')
@@ -266,43 +324,60 @@ class Caribbean(OrderedAdultSite, JaActorSite):
                 })
         return actors
 
-    def list_works_between(self, start: date, stop: date) -> List[dict]:
-        works, page = [], 1
-        while True:
-            soup = self.get_soup(f'/listpages/all{page}.htm')
+    def iter_works_between(self, start: date, stop: date) -> Iterator[dict]:
+        page, head = self._seek_page(stop, self.__get_listing, self.__oldest_date)
+        for soup in prefetch(self.__get_listing, self.__has_next, page, head=head):
             for item in soup.select('div.grid-item'):
                 release_date = date.fromisoformat(item.select_one('.meta-data').text.strip())
                 if release_date >= stop:
                     continue
                 if release_date < start:
-                    return works
+                    return
                 wid = item.select_one('[itemprop="url"]')['href'].split('/')[-2]
-                works.append(self.get_work_detail(wid))
-            if 'is-disabled' in soup.select('.pagination-item')[-1].get_attribute_list('class', []):
-                return works
-            page += 1
+                yield self.get_indexed_detail(wid, {'releaseDate': release_date})
+
+    def __get_listing(self, page) -> BeautifulSoup:
+        return self.get_soup(f'/listpages/all{page}.htm')
+
+    @staticmethod
+    def __has_next(soup) -> bool:
+        return 'is-disabled' not in soup.select('.pagination-item')[-1].get_attribute_list('class', [])
+
+    @staticmethod
+    def __oldest_date(soup) -> Optional[date]:
+        items = soup.select('div.grid-item')
+        return date.fromisoformat(items[-1].select_one('.meta-data').text.strip()) if len(items) > 0 else None
+
+    detail_spec = Extractor(
+        quality=Field('.quality', transform=lambda x: x[:x.index('p') + 1]),
+        title=Field('div.movie-info .heading'),
+        description=Field('div.movie-info [itemprop="description"]'),
+        actors=Field('div.movie-info [itemprop="actor"]', many=True),
+        releaseDate=Field('div.movie-info [itemprop="datePublished"]',
+                          transform=lambda x: datetime.strptime(x, '%Y/%m/%d').date()),
+        duration=Field('div.movie-info [itemprop="duration"]', transform=lambda x: not_blank(
+            x.strip(':').replace(' ', '').replace('：', ":").replace(';', ':'))),
+        genres=Field('div.movie-info .spec-item', many=True),
+        images=Field('.gallery .gallery-image', attr='src', many=True)
+    )
 
     def get_work_detail(self, wid) -> dict:
-        soup = self.get_soup(f'/moviepages/{wid}/index.html', cache=True)
-        info = soup.select_one('div.movie-info')
-        quality = soup.select_one(".quality").text.strip()
-        quality = quality[:quality.index('p') + 1]
-        gallery = soup.select_one('.gallery')
-        duration_op = OptionalValue(info.select_one('[itemprop="duration"]')).map(lambda x: x.text.strip().strip(':'))
+        return self._get_detail_by_page(wid)
+
+    def detail_page(self, wid) -> DetailPage:
+        return DetailPage(f'/moviepages/{wid}/index.html', fragment=['div.movie-info', '.quality', '.gallery'])
+
+    @classmethod
+    def parse_detail(cls, root_uri, wid, soup) -> dict:
+        work = cls.detail_spec.extract(soup)
+        quality = work.pop('quality')
         return {
+            **work,
             'wid': wid,
-            'cover2': self.root_uri + f'/moviepages/{wid}/images/l_l.jpg',
+            'cover2': root_uri + f'/moviepages/{wid}/images/l_l.jpg',
             'trailer': f'https://smovie.caribbeancom.com/sample/movies/{wid}/{quality}.mp4',
-            'title': info.select_one('.heading').text.strip(),
-            'description': info.select_one('[itemprop="description"]').text.strip(),
-            'actors': [x.text.strip() for x in info.select('[itemprop="actor"]')],
-            'releaseDate': datetime.strptime(info.select_one('[itemprop="datePublished"]').text.strip(),
-                                             '%Y/%m/%d').date(),
-            'duration': duration_op.map(lambda x: x.replace(' ', '').replace('：', ":").replace(';', ':')).get(),
-            'genres': [x.text.strip() for x in info.select('.spec-item')],
-            'images': [self.root_uri + x['src'].replace('/s/', '/l/') for x in
-                       gallery.select('.gallery-image')] if gallery else None,
-            'source': self.root_uri + f'/moviepages/{wid}/index.html'
+            'images': [root_uri + x.replace('/s/', '/l/') for x in work['images']] or None,
+            'source': root_uri + f'/moviepages/{wid}/index.html'
         }
 
     def refactor_work(self, work: dict) -> None:
@@ -322,20 +397,34 @@ class OnePondo(OrderedAdultSite, JaActorSite):
         super().refactor_actor(actor)
         actor['source'] = self.root_uri + f'/search/?a={actor["id"]}'
 
-    def list_works_between(self, start: date, stop: date) -> List[dict]:
-        works, index = [], 0
-        while True:
-            data = self.get_json(f'/dyn/phpauto/movie_lists/list_newest_{index}.json')
+    def iter_works_between(self, start: date, stop: date) -> Iterator[dict]:
+        split = 0
+
+        def get_listing(page):
+            nonlocal split
+            # the first page is fetched first when seeking, so the size of pages is known for following ones
+            data = self.get_json(f'/dyn/phpauto/movie_lists/list_newest_{page * split}.json')
+            split = data['SplitSize']
+            return data
+
+        def oldest_date(data):
+            return date.fromisoformat(data['Rows'][-1]['Release']) if len(data['Rows']) > 0 else None
+
+        def parse_page(data):
             for row in data['Rows']:
                 row['releaseDate'] = date.fromisoformat(row['Release'])
+            return math.ceil(data['TotalRows'] / data['SplitSize']), data['Rows']
+
+        first, head = self._seek_page(stop, get_listing, oldest_date, 0)
+        for rows in paginate(lambda x: parse_page(get_listing(x)), first,
+                             stop=lambda x: len(x) == 0 or x[-1]['releaseDate'] < start,
+                             head=None if head is None else parse_page(head)):
+            for row in rows:
                 if row['releaseDate'] >= stop:
                     continue
                 if row['releaseDate'] < start:
-                    return works
-                works.append(row)
-            index += data['SplitSize']
-            if index >= data['TotalRows']:
-                return works
+                    return
+                yield row
 
     def get_work_detail(self, wid) -> dict:
         return self.get_json(f'/dyn/phpauto/movie_details/movie_id/{wid}.json', cache=True)
@@ -366,25 +455,41 @@ class Kin8tengoku(OrderedAdultSite):
     def __init__(self):
         super().__init__('https://www.kin8tengoku.com/index.html', name='金髪天國', encoding='EUC-JP')
 
-    def list_works_between(self, start: date, stop: date) -> List[dict]:
-        works, page = [], 1
-        while True:
-            soup = self.get_soup(f'/listpages/all_{page}.htm')
+    def iter_works_between(self, start: date, stop: date) -> Iterator[dict]:
+        # details of the last works of pages seeking by
+        seeking: Dict[str, dict] = {}
+
+        def oldest_date(soup):
+            items = soup.select('.movie_list')
+            if len(items) == 0:
+                return None
+            wid = items[-1].select_one('a')['href'].split('/')[-2]
+            seeking[wid] = self.get_work_detail(wid)
+            return seeking[wid]['releaseDate']
+
+        page, head = self._seek_page(stop, lambda x: self.get_soup(f'/listpages/all_{x}.htm'), oldest_date)
+        for soup in prefetch(lambda x: self.get_soup(f'/listpages/all_{x}.htm'), self.__has_next, page, head=head):
             for item in soup.select('.movie_list'):
                 wid = item.select_one('a')['href'].split('/')[-2]
-                work = self.get_work_detail(wid)
+                work = seeking.pop(wid, None) or self.get_work_detail(wid)
                 if work['releaseDate'] >= stop:
                     continue
                 if work['releaseDate'] < start:
-                    return works
-                works.append(work)
-            page += 1
-            last = soup.select('.pagenation li')[-1]
-            if 'next' not in last.get_attribute_list('class', []):
-                return works
+                    return
+                yield work
+
+    @staticmethod
+    def __has_next(soup) -> bool:
+        return 'next' in soup.select('.pagenation li')[-1].get_attribute_list('class', [])
 
     def get_work_detail(self, wid) -> dict:
-        soup = self.get_soup(f'/moviepages/{wid}/index.html', cache=True)
+        return self._get_detail_by_page(wid)
+
+    def detail_page(self, wid) -> DetailPage:
+        return DetailPage(f'/moviepages/{wid}/index.html')
+
+    @classmethod
+    def parse_detail(cls, root_uri, wid, soup) -> dict:
         if int(wid) >= 1155:
             trailer = f'https://smovie.kin8tengoku.com/{wid}/pht/sample.mp4'
         else:
@@ -393,7 +498,7 @@ class Kin8tengoku(OrderedAdultSite):
         return {
             'wid': wid,
             'title': OptionalValue(soup.select_one('.sub_title')).get(soup.select_one('.sub_title_vip')).text.strip(),
-            'cover2': self.root_uri + f'/{wid}/pht/1.jpg',
+            'cover2': root_uri + f'/{wid}/pht/1.jpg',
             'trailer': trailer,
             'actors': [x.text.strip() for x in infos[0].select('a')],
             'genres': [x.text.strip() for x in infos[1].select('a')],
@@ -401,7 +506,7 @@ class Kin8tengoku(OrderedAdultSite):
             'releaseDate': date.fromisoformat(infos[3].select('td')[-1].text.strip()),
             'description': infos[4].text.strip(),
             'images': ['https:' + x['src'].replace('.jpg', '_lg.jpg') for x in soup.select('#gallery img')],
-            'source': self.root_uri + f'/moviepages/{wid}/index.html'
+            'source': root_uri + f'/moviepages/{wid}/index.html'
         }
 
     def refactor_work(self, work: dict) -> None:
@@ -473,15 +578,19 @@ class SODPrime(OrderedAdultSite, JaActorSite):
     NO_IMAGE = '/prime/videos/thumbnail/now'
 
     def __init__(self):
-        super().__init__('https://ec.sod.co.jp/prime/', name='sod', headers={'Referer': 'https://ec.sod.co.jp/prime/'})
+        super().__init__('https://ec.sod.co.jp/prime/', name='sod', headers={'Referer': 'https://ec.sod.co.jp/prime/'},
+                         rate=2, burst=4)
         self.__timestamp = None
+        self.__lock = threading.Lock()
 
-    def _do_get(self, path, params=None):
-        current = time.time()
-        if self.__timestamp is None or current - self.__timestamp > 1800:
-            self.__timestamp = current
-            super()._do_get('/prime/_ontime.php')
-        return super()._do_get(path, params)
+    def _do_get_response(self, path, params=None, headers=None):
+        with self.__lock:
+            current = time.time()
+            if self.__timestamp is None or current - self.__timestamp > 1800:
+                # cookies are shared by the threads
+                super()._do_get_response('/prime/_ontime.php')
+                self.__timestamp = current
+        return super()._do_get_response(path, params, headers)
 
     def list_actors(self) -> List[dict]:
         actors = []
@@ -501,17 +610,18 @@ class SODPrime(OrderedAdultSite, JaActorSite):
                 total = int(page_list[-1].text.strip()) if len(page_list) > 0 else 0
         return actors
 
-    def list_works_between(self, start: date, stop: date) -> List[dict]:
-        works, page = [], 0
+    def iter_works_between(self, start: date, stop: date) -> Iterator[dict]:
+        page, soup = self._seek_page(stop, self.__get_listing, self.__oldest_date, 0)
         while True:
-            soup = self.get_soup(f'/prime/videos/genre/', params={'sort': 3, 'page': page})
+            if soup is None:
+                soup = self.__get_listing(page)
             for box in soup.select('#videos_s_mainbox'):
                 contents = box.select_one('.videis_s_star p').contents
-                release_date = datetime.strptime(contents[2].text.strip().replace(' ', '')[-11:], '%Y年%m月%d日').date()
+                release_date = self.__release_date(box)
                 if release_date >= stop:
                     continue
                 if release_date < start:
-                    return works
+                    return
                 wid = box.select_one('a')['href'].split('=')[-1]
                 work = {
                     'wid': wid,
@@ -524,21 +634,37 @@ class SODPrime(OrderedAdultSite, JaActorSite):
                     'source': self.root_uri + '/prime/videos/?id=' + wid,
                 }
                 try:
-                    work.update(self.get_work_detail(wid))
+                    work.update(self.get_indexed_detail(wid, dict(work)))
                 except NotFound:
                     pass
-                works.append(work)
+                yield work
             page += 1
             if page >= int(soup.select('#page_list a')[-1].text.strip()):
-                return works
+                return
+            soup = None
+
+    def __get_listing(self, page) -> BeautifulSoup:
+        return self.get_soup(f'/prime/videos/genre/', params={'sort': 3, 'page': page})
+
+    @classmethod
+    def __oldest_date(cls, soup) -> Optional[date]:
+        boxes = soup.select('#videos_s_mainbox')
+        return cls.__release_date(boxes[-1]) if len(boxes) > 0 else None
+
+    @staticmethod
+    def __release_date(box) -> date:
+        contents = box.select_one('.videis_s_star p').contents
+        return datetime.strptime(contents[2].text.strip().replace(' ', '')[-11:], '%Y年%m月%d日').date()
 
     def get_work_detail(self, wid) -> dict:
         # access the media with 'Referer' header
-        soup = self.get_soup('/prime/videos/', params={'id': wid}, cache=True)
+        soup = self.get_soup('/prime/videos/', params={'id': wid}, cache=True,
+                             fragment=['#videos_head', '#v_introduction', '.img-gallery'])
         head = soup.select_one('#videos_head')
         if head is None:
             raise NotFound
-        video_soup = self.get_soup('/prime/videos/sample.php', params={'id': wid}, cache=True)
+        video_soup = self.get_soup('/prime/videos/sample.php', params={'id': wid}, cache=True,
+                                   fragment=['#v_introduction', '#moviebox'])
         infos = soup.select('#v_introduction tr')
         if len(infos) == 0:
             infos = video_soup.select('#v_introduction tr')
@@ -574,12 +700,14 @@ class SODPrime(OrderedAdultSite, JaActorSite):
 
 
 class Prestige(OrderedAdultSite, JaActorSite):
+    freshness = [('/api/search\\?.*date\\[]=(?P<date>\\d{4}-\\d{2}-\\d{2})', daily_freshness(7))]
     nuxt_regexp = re.compile('window.__NUXT__=(.*);')
     js_ctx = execjs.compile('')
     prefixes = ['GOOE', 'PTKT', 'CTKT', 'STKT', 'TKT']
 
     def __init__(self):
-        super().__init__('https://prestige-av.com', name='Prestige', headers={'Cookie': '__cred__=; __age_auth__=true'})
+        super().__init__('https://prestige-av.com', name='Prestige', headers={'Cookie': '__cred__=; __age_auth__=true'},
+                         rate=2, burst=4)
 
     def list_actors(self) -> List[dict]:
         return self.get_json('/api/actress')['list']
@@ -591,8 +719,8 @@ class Prestige(OrderedAdultSite, JaActorSite):
         actor['enName'] = OptionalValue(actor['nameRoma']).not_blank().map(lambda x: format_en_name(x, True)).get()
         actor['image'] = OptionalValue(actor['media']).map(lambda x: self.media(x['path'])).get()
 
-    def list_works_between(self, start: date, stop: date) -> List[dict]:
-        works = OrderedDict()
+    def iter_works_between(self, start: date, stop: date) -> Iterator[dict]:
+        seen = set()
         for release in self.get_json('/api/sku/salesDate', params={'sort': 'desc'}):
             release_date = date.fromisoformat(release['salesStartAt'])
             if release_date >= stop:
@@ -604,20 +732,20 @@ class Prestige(OrderedAdultSite, JaActorSite):
                 'date[]': release['salesStartAt'],
                 'from': 0, 'size': 100, 'order': 'new'
             }
-            data = self.get_json('/api/search', params=params, cache=date.today() - release_date >= timedelta(days=7))
+            data = self.get_json('/api/search', params=params)
             for doc in data['hits']['hits']:
                 source: dict = doc['_source']
                 source['releaseDate'] = release_date
                 sn = self._format_sn(source['deliveryItemId'])
-                if sn not in works:
+                if sn not in seen:
                     # this is blocked
                     # try:
                     #     source.update(self.get_work_detail(source['productUuid']))
                     # except (NotFound, RequestException) as ex:
                     #     log.warning(f'Cannot to get work detail of {sn} from {self.name}: {ex}')
                     #     continue
-                    works[sn] = source
-        return list(works.values())
+                    seen.add(sn)
+                    yield source
 
     def get_work_detail(self, wid) -> dict:
         soup = self.get_soup(f'/goods/{wid}', cache=True)
@@ -655,11 +783,13 @@ class Prestige(OrderedAdultSite, JaActorSite):
 
 
 class Venus(MonthlyAdultSite):
+    freshness = [('/products/(?P<year>\\d{4})/(?P<month>\\d{2})$', monthly_freshness)]
+
     def __init__(self):
         super().__init__('https://venus-av.com/', YearMonth(2009, 4), name='VENUS')
 
     def _list_monthly(self, ym: YearMonth) -> List[dict]:
-        soup = self.get_soup('/products/%04d/%02d/' % (ym.year, ym.month), cache=ym < YearMonth.now())
+        soup = self.get_soup('/products/%04d/%02d/' % (ym.year, ym.month))
         return [{'wid': unquote(li.select_one('a')['href'].split('/')[-2])} for li in
                 soup.select('.topNewreleaseList li')]
 
@@ -682,6 +812,7 @@ class Venus(MonthlyAdultSite):
 
 
 class Indies(MonthlyAdultSite, JaActorSite):
+    freshness = [('/ym/(?P<year>\\d{4})(?P<month>\\d{2})$', monthly_freshness)]
     measurements_regexp = re.compile('B:(\\d{2,3})?cm\\(([A-O])?カップ\\) / W: (\\d{2})?cm / H:(\\d{2,3})?cm')
 
     def __init__(self):
@@ -742,7 +873,7 @@ class Indies(MonthlyAdultSite, JaActorSite):
 
     def _list_monthly(self, ym: YearMonth) -> List[dict]:
         indices = []
-        soup = self.get_soup('/ym/%04d%02d/' % (ym.year, ym.month), cache=ym < YearMonth.now())
+        soup = self.get_soup('/ym/%04d%02d/' % (ym.year, ym.month))
         for item in reversed(soup.select('ul.d-md-flex li.package')):
             metadata = dict([(x['itemprop'], x['content']) for x in item.select('meta')])
             indices.append({
@@ -784,29 +915,27 @@ class Indies(MonthlyAdultSite, JaActorSite):
 
 
 class Planetplus(MonthlyAdultSite):
+    freshness = [('/wp01/tag/(?P<year>\\d{4})年(?P<month>\\d{2})月/', monthly_freshness)]
+
     def __init__(self):
         super().__init__('http://planetplus.jp/wp01/', YearMonth(2008, 6), name='Planetplus')
         self.__tags = {}
 
     def _list_monthly(self, ym: YearMonth) -> List[dict]:
-        indices, page = [], 1
-        while True:
-            soup = self.get_soup('/wp01/tag/%04d年%02d月/page/%d/' % (ym.year, ym.month, page),
-                                 cache=ym < YearMonth.now())
+        indices = []
+        for soup in prefetch(lambda x: self.get_soup('/wp01/tag/%04d年%02d月/page/%d/' % (ym.year, ym.month, x)),
+                             lambda x: OptionalValue(x.select_one('.pagination .current')).map(
+                                 lambda y: y.find_next_sibling('a')).get() is not None):
             for article in soup.select('article'):
                 indices.append({
                     'wid': article['id'].split('-')[-1],
                     'cover': article.select_one('img')['data-src']
                 })
-            if OptionalValue(soup.select_one('.pagination .current')).map(
-                    lambda x: x.find_next_sibling('a')).get() is None:
-                break
-            page += 1
         return indices
 
     def get_work_detail(self, wid) -> dict:
         data = self.get_json(f'/wp01/wp-json/wp/v2/posts/{wid}', cache=True)
-        content = BeautifulSoup(data['content']['rendered'], 'html.parser')
+        content = make_soup(data['content']['rendered'], self.parser)
         infos = content.select('table div[align]')
         genres = []
         for tid in data['tags']:
@@ -835,8 +964,8 @@ class Deeps(OrderedAdultSite):
     def __init__(self):
         super().__init__('https://deeps.net/', name="DEEP'S")
 
-    def list_works_between(self, start: date, stop: date) -> List[dict]:
-        works, page = [], 1
+    def iter_works_between(self, start: date, stop: date) -> Iterator[dict]:
+        page = 1
         while True:
             soup = self.get_soup('/item/', params={'sort': 'new', 'p': page})
             for li in soup.select('.product_list_wrap .list_box li'):
@@ -845,10 +974,10 @@ class Deeps(OrderedAdultSite):
                 if work['releaseDate'] >= stop:
                     continue
                 if work['releaseDate'] < start:
-                    return works
-                works.append(work)
+                    return
+                yield work
             if page >= int(soup.select('.pager a')[-1]['href'].split('=')[-1]):
-                return works
+                return
             page += 1
 
     def get_work_detail(self, wid) -> dict:
@@ -897,8 +1026,8 @@ class Maxing(OrderedAdultSite, JaActorSite):
                 return actors
             page += 1
 
-    def list_works_between(self, start: date, stop: date) -> List[dict]:
-        works, page, over = [], 0, False
+    def iter_works_between(self, start: date, stop: date) -> Iterator[dict]:
+        page, over = 0, False
         while not over:
             soup = self.get_soup(f'/shop/src/page/{page}.html')
             for td in soup.select('#shopList .proTd'):
@@ -907,15 +1036,15 @@ class Maxing(OrderedAdultSite, JaActorSite):
                 if release_date >= stop:
                     continue
                 if release_date < start:
-                    return works
+                    return
                 work = {
                     'wid': td.select_one('a')['href'].split('/')[-1].split('.')[0],
                     'cover': td.select_one('img')['src'],
                     'releaseDate': release_date
                 }
-                works.append({**work, **self.get_work_detail(work['wid'])})
+                yield {**work, **self.get_indexed_detail(work['wid'], work)}
             if soup.select('p[align] a')[-1].select_one('img') is None:
-                return works
+                return
             page += 1
 
     def get_work_detail(self, wid) -> dict:
@@ -946,12 +1075,14 @@ class Maxing(OrderedAdultSite, JaActorSite):
 
 
 class CrystalEizou(MonthlyAdultSite):
+    freshness = [('/info/archive/(?P<year>\\d{4})_(?P<month>\\d{2})\\.html', monthly_freshness)]
+
     def __init__(self):
         super().__init__('https://www.crystal-eizou.jp/info/index.html', YearMonth(2014, 5), name='クリスタル映像')
 
     def _list_monthly(self, ym: YearMonth) -> List[dict]:
         path = '/info/archive/%04d_%02d.html' % (ym.year, ym.month)
-        soup = self.get_soup(path, cache=ym < YearMonth.now())
+        soup = self.get_soup(path)
         works = []
         for section in reversed(soup.select('.itemSection')):
             infos = section.select('.right2 p')
@@ -984,6 +1115,8 @@ class CrystalEizou(MonthlyAdultSite):
 
 
 class KmProduce(MonthlyAdultSite, JaActorSite):
+    freshness = [('/works\\?archive=(?P<year>\\d{4})年(?P<month>\\d{1,2})月', monthly_freshness)]
+
     def __init__(self):
         super().__init__('https://www.km-produce.com/', YearMonth(2012, 12), name='K.M.Produce')
 
@@ -1003,7 +1136,7 @@ class KmProduce(MonthlyAdultSite, JaActorSite):
         super().refactor_actor(actor)
 
     def _list_monthly(self, ym: YearMonth) -> List[dict]:
-        soup = self.get_soup('/works', {'archive': f'{ym.year}年{ym.month}月'}, cache=ym < YearMonth.now())
+        soup = self.get_soup('/works', {'archive': f'{ym.year}年{ym.month}月'})
         works = []
         for article in soup.select('article.post'):
             img = article.select_one('img')
@@ -1041,18 +1174,21 @@ class KmProduce(MonthlyAdultSite, JaActorSite):
 
 
 class AliceJapan(MonthlyAdultSite, JaActorSite):
+    freshness = [('/search_item\\.php\\?date_word=(?P<year>\\d{4})(?P<month>\\d{2})', monthly_freshness)]
 
     def __init__(self):
         super().__init__('https://www.alicejapan.co.jp/top.php', YearMonth(1984, 5), name='アリスJAPAN',
-                         headers={'Cookie': 'ageverification=t'})
+                         headers={'Cookie': 'ageverification=t'}, parser='lxml', workers=8, rate=4, burst=8)
 
     def _list_monthly(self, ym: YearMonth) -> List[dict]:
-        indices, page = [], 0
-        while True:
+        def fetch_page(page):
             params = {'date_word': '%04d%02d' % (ym.year, ym.month)}
             if page > 0:
                 params['p'] = page
-            soup = self.get_soup('/search_item.php', params=params, cache=ym < YearMonth.now())
+            return self.get_soup('/search_item.php', params=params)
+
+        indices = []
+        for soup in prefetch(fetch_page, lambda x: x.select_one('.pager-last a') is not None, 0):
             for item in soup.select('.video-list li'):
                 url = urlparse(urljoin(self.root_uri, item.select_one('a')['href']))
                 indices.append({
@@ -1061,9 +1197,6 @@ class AliceJapan(MonthlyAdultSite, JaActorSite):
                     'cover': item.select_one('img')['src'],
                     'source': url.geturl()
                 })
-            if soup.select_one('.pager-last a') is None:
-                break
-            page += 1
         return indices
 
     def get_work_detail(self, wid) -> dict:
@@ -1129,23 +1262,60 @@ jav_producers = [
 def persist_producer(site: AdultSite, data_dir, export_api):
     log.info('Start persisting actors and works of %s', site.hostname)
 
-    try:
-        actor_path = os.path.join(data_dir, 'actor', site.hostname + '.json')
-        if isinstance(site, ActorSite):
-            export.import_data(actor_path, site.list_actors, site.refactor_actor)
-            export.export_data(actor_path, export_api.import_actor)
-
-        work_path = os.path.join(data_dir, 'work', site.hostname + '.json')
-        if isinstance(site, OrderedAdultSite):
-            export.import_ordered_works(work_path, site)
-        elif isinstance(site, MonthlyAdultSite):
-            export.import_monthly_works(work_path, site)
-        else:
-            export.import_data(work_path, site.list_works, site.refactor_work)
-        export.export_data(work_path, export_api.import_work)
-        log.info('Successfully persist actors and works of %s', site.hostname)
-    except Exception as ex:
-        log.error('Fail to persist actors and works of %s: %s', site.hostname, ex)
+    actor_path = os.path.join(data_dir, 'actor', site.hostname + '.json')
+    if isinstance(site, ActorSite):
+        export.import_data(actor_path, site.list_actors, site.refactor_actor)
+        export.export_data(actor_path, export_api.import_actor)
+
+    work_path = os.path.join(data_dir, 'work', site.hostname + '.json')
+    if isinstance(site, OrderedAdultSite):
+        export.import_ordered_works(work_path, site, export_func=export_api.import_work)
+    elif isinstance(site, MonthlyAdultSite):
+        export.import_monthly_works(work_path, site, export_func=export_api.import_work)
+    else:
+        export.import_data(work_path, site.list_works, site.refactor_work)
+    export.export_data(work_path, export_api.import_work)
+    index_stats = site.work_index_stats()
+    if index_stats is not None:
+        log.info('Details of works of %s: %s', site.hostname, index_stats)
+    log.info('Successfully persist actors and works of %s', site.hostname)
+
+
+def persist_producers(producers: List[AdultSite], data_dir, export_api, workers=4) -> List[dict]:
+    """
+    Persists the producers concurrently, the slowest ones of last time first.
+    Wall times are kept in the data directory to order the next run.
+    """
+    times_path = os.path.join(data_dir, 'wall-times.json')
+    wall_times = {}
+    if os.path.exists(times_path):
+        with open(times_path, 'r', encoding='utf-8') as fp:
+            wall_times = json.load(fp)
+    scheduler = Scheduler(workers)
+    for producer in producers:
+        scheduler.submit(producer.name, functools.partial(persist_producer, producer, data_dir, export_api),
+                         producer.hostname, int(wall_times.get(producer.name, 0)))
+    results = scheduler.run()
+    for result in results:
+        if result['error'] is None:
+            wall_times[result['name']] = result['wallTime']
+    with open(times_path, 'w', encoding='utf-8') as fp:
+        json.dump(wall_times, fp, ensure_ascii=False)
+    return results
+
+
+def print_summary(producers: List[AdultSite], results: List[dict]):
+    retries = default_retry_policy.stats()
+    by_name = dict((x.name, x) for x in producers)
+    print('%-16s %-24s %10s %8s %8s %8s  %s' % ('Producer', 'Host', 'Wall(s)', 'Requests', 'Retries', 'Failures',
+                                               'Error'))
+    for result in sorted(results, key=lambda x: x['wallTime'], reverse=True):
+        producer = by_name[result['name']]
+        host_retries = retries.get(producer.hostname, {})
+        print('%-16s %-24s %10.1f %8d %8d %8d  %s' % (
+            result['name'], producer.hostname, result['wallTime'], producer.request_count,
+            host_retries.get('retries', 0), host_retries.get('failures', 0),
+            '-' if result['error'] is None else str(result['error'])[:60]))
 
 
 def read_kwargs() -> argparse.Namespace:
@@ -1154,6 +1324,7 @@ def read_kwargs() -> argparse.Namespace:
     parser.add_argument('-p', '--port', type=int, default=80, help='specify the port number')
     parser.add_argument('-d', '--data-dir', default='', help='specify the directory of data')
     parser.add_argument('-e', '--excluded', default='', help='specify excluded producers, separated by comma')
+    parser.add_argument('-w', '--workers', type=int, default=4, help='specify max count of producers run at once')
     parser.add_argument('--help', action='help')
     return parser.parse_args()
 
@@ -1170,8 +1341,15 @@ if __name__ == '__main__':
         os.makedirs(dirpath, exist_ok=True)
     excluded = set(x.strip() for x in args.excluded.strip().split(','))
 
+    included = []
     for producer in will_producers + jav_producers + d2pass_producers:
         if producer.name in excluded:
             log.info('skip producer: ' + producer.name)
             continue
-        persist_producer(producer, dirpath, kingen_api)
+        included.append(producer)
+    print_summary(included, persist_producers(included, dirpath, kingen_api, args.workers))
+    log.info('Connection pools: %s', pools.stats())
+    log.info('Rate limits: %s', rate_limiter.stats())
+    log.info('Retries: %s', default_retry_policy.stats())
+    log.info('Memory cache: %s', memory_cache.stats())
+    log.info('Coalesced requests: %s', flights.stats())
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+"""
+Pipeline to crawl details of works, where threads only fetch pages and a pool of processes parses them.
+
+@Author Kingen
+"""
+import argparse
+import json
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, Future
+from typing import Iterable, Iterator, List, Tuple, Type, Union
+
+from scrapy.exceptions import NotSupported
+from werkzeug.exceptions import HTTPException
+
+import common
+from common import ComplexEncoder
+from internet import DuplicateError
+from internet.adult import AdultSite, DetailPage
+from internet.parsers import make_soup
+
+log = common.get_logger()
+
+
+def parse_page(site_type: Type[AdultSite], root_uri, wid, page: str, parser, fragment) -> dict:
+    """
+    Parses the page of the work in a worker process.
+    """
+    return site_type.parse_detail(root_uri, wid, make_soup(page, parser, fragment))
+
+
+class ParsePipeline:
+    """
+    Fetches pages of works by threads and parses them by processes, so parsing is not limited by the GIL.
+    Sites not supporting detail_page are crawled by threads only.
+    """
+
+    def __init__(self, site: AdultSite, io_workers=8, processes=None, window=64):
+        """
+        @param io_workers: count of threads to fetch pages
+        @param processes: count of processes to parse pages, count of CPUs if not specified
+        @param window: max count of works fetched or parsed at once
+        """
+        self.__site = site
+        self.__fetchers = ThreadPoolExecutor(io_workers, thread_name_prefix='fetch-' + site.hostname)
+        self.__parsers = ProcessPoolExecutor(processes)
+        self.__window = max(window, io_workers)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        self.__fetchers.shutdown(cancel_futures=True)
+        self.__parsers.shutdown(cancel_futures=True)
+
+    def get_work_details(self, wids: Iterable[str]) -> Iterator[Tuple[str, Union[dict, BaseException]]]:
+        """
+        @return: details of the works, or exceptions failing them, in the order of wids
+        """
+        pending: deque = deque()
+        for wid in wids:
+            pending.append((wid, self.__fetchers.submit(self.__fetch_and_parse, wid)))
+            if len(pending) >= self.__window:
+                yield self.__result(*pending.popleft())
+        while len(pending) > 0:
+            yield self.__result(*pending.popleft())
+
+    def update_works(self, works: List[dict], refactor=False) -> List[dict]:
+        """
+        Updates the works with their details. Duplicate works are dropped and works failing to fetch are kept as is.
+        @param refactor: whether to refactor updated works by the site, works failing to fetch are not refactored
+        """
+        updated = []
+        for work, (wid, detail) in zip(works, self.get_work_details(x['wid'] for x in works)):
+            if isinstance(detail, DuplicateError):
+                continue
+            if isinstance(detail, (HTTPException, NotSupported)):
+                log.warning('Fail to get the detail of %s: %s', wid, detail)
+            elif isinstance(detail, BaseException):
+                raise detail
+            else:
+                work.update(detail)
+                if refactor:
+                    self.__site.refactor_work(work)
+            updated.append(work)
+        return updated
+
+    def __fetch_and_parse(self, wid) -> Future:
+        site = self.__site
+        page: DetailPage = site.detail_page(wid)
+        if page is None:
+            future = Future()
+            future.set_result(site.get_work_detail(wid))
+            return future
+        content = site._do_get_cacheable(page.path, page.params, True, False)
+        return self.__parsers.submit(parse_page, type(site), site.root_uri, wid, content, site.parser, page.fragment)
+
+    @staticmethod
+    def __result(wid, future: Future) -> Tuple[str, Union[dict, BaseException]]:
+        try:
+            return wid, future.result().result()
+        except Exception as ex:
+            return wid, ex
+
+
+def reparse_works(filepath, site: AdultSite, io_workers=8, processes=None) -> int:
+    """
+    Reparses details of works in the json file persisted by internet.adult.export, mostly from cached pages.
+    Only sites parsing details from pages by parse_detail are supported, since persisted works are refactored already.
+    @return: count of reparsed works
+    """
+    if type(site).detail_page is AdultSite.detail_page:
+        raise NotSupported(f'details of {site.name} are not parsed from pages')
+    with open(filepath, 'r', encoding='utf-8') as fp:
+        records: List[dict] = json.load(fp)
+    count = 0
+    with ParsePipeline(site, io_workers, processes) as pipeline:
+        for record in records:
+            works = pipeline.update_works(record['data'], True)
+            record['data'] = works
+            record['count'] = len(works)
+            count += len(works)
+    with open(filepath, 'w', encoding='utf-8') as fp:
+        json.dump(records, fp, ensure_ascii=False, cls=ComplexEncoder)
+    return count
+
+
+def read_kwargs() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Reparse persisted works of producers with a pool of processes.')
+    parser.add_argument('names', nargs='+', help='specify names of producers')
+    parser.add_argument('-d', '--data-dir', default='', help='specify the directory of data')
+    parser.add_argument('-t', '--threads', type=int, default=8, help='specify count of threads to fetch pages')
+    parser.add_argument('-p', '--processes', type=int, help='specify count of processes to parse pages')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    from internet.adult.ja import will_producers, jav_producers, d2pass_producers
+
+    args = read_kwargs()
+    dirpath = args.data_dir
+    if dirpath is None or dirpath.strip() == '':
+        dirpath = os.path.join(os.getenv('TEMP'), 'export-ja')
+    producers = dict((x.name, x) for x in will_producers + jav_producers + d2pass_producers)
+    for name in args.names:
+        producer = producers[name]
+        work_path = os.path.join(dirpath, 'work', producer.hostname + '.json')
+        log.info('Reparsed %d works of %s', reparse_works(work_path, producer, args.threads, args.processes), name)
@@ -16,6 +16,7 @@ from werkzeug.exceptions import NotFound
 from internet import base_headers
 from internet.adult import AdultSite, ActorSite, export
 from internet.adult.ja import read_kwargs
+from internet.parallel import paginate
 
 
 class HuiAV(AdultSite, ActorSite):
@@ -30,7 +31,7 @@ class HuiAV(AdultSite, ActorSite):
         return self.__list_records_by_page(lambda x: self.__parse_actor_indices(f'/home/0_{x}.html'))
 
     def __parse_actor_indices(self, path) -> Tuple[int, List[dict]]:
-        soup = self.get_soup(path, cache=True)
+        soup = self.get_soup(path, cache=True, fragment='.actor_box')
         total = int(soup.select_one('.actor_box h1 span').text.strip()[:-3])
         return total, [{
             'aid': ul.select_one('li.eye')['vid'],
@@ -55,7 +56,7 @@ class HuiAV(AdultSite, ActorSite):
         return works
 
     def __parse_work_indices(self, path) -> Tuple[int, List[dict]]:
-        soup = self.get_soup(path)
+        soup = self.get_soup(path, fragment='.actor_box')
         actor_box = soup.select_one('.actor_box')
         if actor_box is None:
             return 0, []
@@ -119,14 +120,13 @@ class HuiAV(AdultSite, ActorSite):
         filesize *= 1024
         return int(filesize)
 
-    def __list_records_by_page(self, parse_func) -> List[dict]:
-        page_index, stop, records = 1, 1, []
-        while page_index <= stop:
+    @staticmethod
+    def __list_records_by_page(parse_func) -> List[dict]:
+        def fetch_page(page_index):
             total, data = parse_func(page_index)
-            records.extend(data)
-            page_index += 1
-            stop = math.ceil(total / 36)
-        return records
+            return math.ceil(total / 36) + 1, data
+
+        return [x for data in paginate(fetch_page) for x in data]
 
 
 def export_resources(api, work):
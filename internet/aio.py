@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+"""
+Asynchronous operations for Internet.
+
+@Author Kingen
+"""
+import asyncio
+import functools
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Callable, Any, Iterable, Optional
+
+import common
+from internet import BaseSite
+from internet.parsers import Fragment
+
+log = common.get_logger()
+
+
+class AsyncBaseSite:
+    """
+    Asyncio sibling of BaseSite.
+
+    Requests are delegated to the wrapped site and run in a thread pool, so the caching of run_cacheable and
+    the hooks overridden by subclasses (like _do_get_response) keep their semantics. Any other method of the site,
+    like get_work_detail, is exposed as a coroutine function too, so parsers need no rewriting.
+
+    Requests to the same host are limited by a semaphore shared by all instances.
+    """
+    _host_limits: Dict[str, int] = {}
+    _semaphores = weakref.WeakKeyDictionary()
+
+    def __init__(self, site: BaseSite, limit=8):
+        """
+        @param site: the site to wrap
+        @param limit: max count of requests in flight to the host of the site, unless set by set_host_limit
+        """
+        self.__site = site
+        self.__limit = self._host_limits.get(site.hostname, limit)
+        self.__executor = ThreadPoolExecutor(max_workers=self.__limit, thread_name_prefix=site.name)
+
+    @classmethod
+    def set_host_limit(cls, hostname: str, limit: int):
+        cls._host_limits[hostname] = limit
+
+    @property
+    def site(self):
+        return self.__site
+
+    @property
+    def limit(self):
+        return self.__limit
+
+    async def get_soup(self, path, params=None, cache=None, retry=False, parser=None,
+                       fragment: Optional[Fragment] = None):
+        return await self.run(self.__site.get_soup, path, params, cache, retry, parser, fragment)
+
+    async def get_json(self, path, params=None, cache=None, retry=False):
+        return await self.run(self.__site.get_json, path, params, cache, retry)
+
+    async def post_json(self, path, query=None, cache=False, retry=False, **kwargs):
+        return await self.run(self.__site.post_json, path, query, cache, retry, **kwargs)
+
+    async def put_json(self, path, query=None, cache=False, retry=False, **kwargs):
+        return await self.run(self.__site.put_json, path, query, cache, retry, **kwargs)
+
+    async def run(self, func: Callable, *args, **kwargs):
+        """
+        Runs the blocking function in the thread pool under the limit of the host.
+        """
+        async with self.__semaphore():
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.__executor, functools.partial(func, *args, **kwargs))
+
+    async def gather(self, func: Callable, args_list: Iterable, return_exceptions=False) -> List[Any]:
+        """
+        Runs the function concurrently for every item of the arguments.
+        @param func: the blocking function, or the coroutine function
+        @param args_list: arguments for every call, a tuple for multiple arguments
+        @param return_exceptions: whether to return exceptions as results instead of raising the first one
+        @return: results in order of the arguments
+        """
+        calls = []
+        for args in args_list:
+            args = args if isinstance(args, tuple) else (args,)
+            calls.append(func(*args) if asyncio.iscoroutinefunction(func) else self.run(func, *args))
+        return await asyncio.gather(*calls, return_exceptions=return_exceptions)
+
+    def close(self):
+        self.__executor.shutdown(wait=False)
+
+    def __getattr__(self, name):
+        if name.startswith('_AsyncBaseSite__'):
+            raise AttributeError(name)
+        attr = getattr(self.__site, name)
+        if not callable(attr):
+            return attr
+
+        @functools.wraps(attr)
+        async def wrapper(*args, **kwargs):
+            return await self.run(attr, *args, **kwargs)
+
+        return wrapper
+
+    def __semaphore(self) -> asyncio.Semaphore:
+        loop = asyncio.get_running_loop()
+        semaphores = self._semaphores.setdefault(loop, {})
+        hostname = self.__site.hostname
+        if hostname not in semaphores:
+            semaphores[hostname] = asyncio.Semaphore(self.__limit)
+        return semaphores[hostname]
+
+
+def run_details(site: BaseSite, wids: Iterable, limit=8, return_exceptions=True) -> List[Any]:
+    """
+    Retrieves details of works concurrently from a synchronous context.
+    @return: details in order of the wids, or exceptions raised for them if return_exceptions is True
+    """
+
+    async def main():
+        async_site = AsyncBaseSite(site, limit)
+        try:
+            return await async_site.gather(async_site.get_work_detail, wids, return_exceptions)
+        finally:
+            async_site.close()
+
+    return asyncio.run(main())
@@ -14,12 +14,15 @@ import internet
 class Bilibili:
     API = 'https://api.bilibili.com'
 
+    def __init__(self):
+        self.__session = internet.pools.mount(requests.session(), self.API)
+
     def __get_data(self, path: str, params: dict) -> dict:
-        json = requests.get(self.API + path, params=params, headers=internet.base_headers).json()
+        json = self.__session.get(self.API + path, params=params, headers=internet.base_headers).json()
         return json['data']
 
     def __get_content(self, path: str, params: dict) -> str:
-        return requests.get(self.API + path, params=params, headers=internet.base_headers).text
+        return self.__session.get(self.API + path, params=params, headers=internet.base_headers).text
 
     def get_series_list(self, userid: int, season_id: int, page_num=1, page_size=30) -> dict:
         params = {
@@ -0,0 +1,643 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+"""
+Stores of cached responses.
+
+@Author Kingen
+"""
+import abc
+import argparse
+import atexit
+import gzip
+import hashlib
+import os
+import pickle
+import sqlite3
+import sys
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from datetime import timedelta
+from typing import Any, Dict, Tuple, Optional, List, Callable
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+import common
+
+log = common.get_logger()
+
+MISSING = object()
+
+
+class Codec:
+    def __init__(self, name: str, encode: Callable[[bytes], bytes], decode: Callable[[bytes], bytes]):
+        self.name = name
+        self.encode = encode
+        self.decode = decode
+
+
+codecs: Dict[str, Codec] = {
+    'identity': Codec('identity', lambda x: x, lambda x: x),
+    'gzip': Codec('gzip', lambda x: gzip.compress(x, 6, mtime=0), gzip.decompress)
+}
+if zstandard is not None:
+    codecs['zstd'] = Codec('zstd', lambda x: zstandard.ZstdCompressor(level=10).compress(x),
+                           lambda x: zstandard.ZstdDecompressor().decompress(x))
+default_codec = 'zstd' if 'zstd' in codecs else 'gzip'
+
+
+class Compressed:
+    """
+    Compressed value which is decompressed only when loaded.
+    """
+    __slots__ = 'codec', 'blob', 'pickled'
+
+    def __init__(self, codec: str, blob: bytes, pickled: bool):
+        self.codec = codec
+        self.blob = blob
+        self.pickled = pickled
+
+    def load(self) -> Any:
+        raw = codecs[self.codec].decode(self.blob)
+        return pickle.loads(raw) if self.pickled else raw
+
+    @classmethod
+    def dump(cls, value, codec: str) -> Tuple['Compressed', int]:
+        """
+        Compresses the value. Bytes are kept as they are, other values are pickled.
+        @return: the compressed value and the size before compressed
+        """
+        pickled = not isinstance(value, bytes)
+        raw = pickle.dumps(value, pickle.HIGHEST_PROTOCOL) if pickled else value
+        blob = codecs[codec].encode(raw)
+        if len(blob) >= len(raw):
+            codec, blob = 'identity', raw
+        return cls(codec, blob, pickled), len(raw)
+
+
+class CacheEntry(namedtuple('CacheEntry', ['data', 'etag', 'last_modified', 'validated'])):
+    @property
+    def value(self):
+        return self.data.load() if isinstance(self.data, Compressed) else self.data
+
+
+class CacheStore(abc.ABC):
+    def get(self, key: str) -> Any:
+        """
+        @return: the cached value, or MISSING if not found
+        """
+        entry = self.get_entry(key)
+        return MISSING if entry is MISSING else entry.value
+
+    @abc.abstractmethod
+    def get_entry(self, key: str) -> Any:
+        """
+        @return: the cached entry with its validators, or MISSING if not found
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def put(self, key: str, value: Any, etag: Optional[str] = None,
+            last_modified: Optional[str] = None) -> CacheEntry:
+        """
+        @param etag: value of the ETag header of the response
+        @param last_modified: value of the Last-Modified header of the response
+        @return: the stored entry
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def touch(self, key: str) -> None:
+        """
+        Marks the entry as validated just now.
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def remove(self, key: str) -> bool:
+        """
+        @return: whether the key was found
+        """
+        raise NotImplementedError
+
+    def flush(self) -> None:
+        pass
+
+    def close(self) -> None:
+        self.flush()
+
+
+class SqliteStore(CacheStore):
+    """
+    Stores all entries of a cache in a single SQLite file in WAL mode.
+    Keys are hashed, writes are committed in batches, and values are compressed by the codec.
+    """
+    migrations = [
+        ['ALTER TABLE entries ADD COLUMN etag TEXT',
+         'ALTER TABLE entries ADD COLUMN last_modified TEXT',
+         'ALTER TABLE entries ADD COLUMN validated REAL'],
+        ['ALTER TABLE entries ADD COLUMN codec TEXT',
+         'ALTER TABLE entries ADD COLUMN pickled INTEGER',
+         'ALTER TABLE entries ADD COLUMN raw_size INTEGER']
+    ]
+
+    def __init__(self, filepath, batch_size=64, batch_interval=5.0, codec=default_codec):
+        """
+        @param filepath: path of the database file
+        @param batch_size: max count of uncommitted writes
+        @param batch_interval: max seconds to keep writes uncommitted
+        @param codec: name of the codec to compress values
+        """
+        os.makedirs(os.path.dirname(os.path.abspath(filepath)), exist_ok=True)
+        self.__filepath = filepath
+        self.__codec = codec
+        self.__batch_size = batch_size
+        self.__batch_interval = batch_interval
+        self.__lock = threading.RLock()
+        self.__conn = sqlite3.connect(filepath, timeout=30, check_same_thread=False, isolation_level='DEFERRED')
+        self.__conn.execute('PRAGMA journal_mode=WAL')
+        self.__conn.execute('PRAGMA synchronous=NORMAL')
+        self.__conn.execute('CREATE TABLE IF NOT EXISTS entries ('
+                            'hash TEXT PRIMARY KEY, key TEXT NOT NULL, value BLOB NOT NULL, size INTEGER NOT NULL, '
+                            'created REAL NOT NULL, accessed REAL NOT NULL)')
+        self.__conn.execute('CREATE INDEX IF NOT EXISTS idx_entries_accessed ON entries (accessed)')
+        version = self.__conn.execute('PRAGMA user_version').fetchone()[0]
+        for i in range(version, len(self.migrations)):
+            for sql in self.migrations[i]:
+                self.__conn.execute(sql)
+            self.__conn.execute(f'PRAGMA user_version = {i + 1}')
+        self.__conn.commit()
+        self.__pending = 0
+        self.__committed_at = time.monotonic()
+        self.__accessed: Dict[str, float] = {}
+
+    @property
+    def filepath(self):
+        return self.__filepath
+
+    def get_entry(self, key: str) -> Any:
+        hashed = hash_key(key)
+        with self.__lock:
+            row = self.__conn.execute('SELECT value, etag, last_modified, COALESCE(validated, created), '
+                                      'COALESCE(codec, \'identity\'), COALESCE(pickled, 1) '
+                                      'FROM entries WHERE hash = ?', (hashed,)).fetchone()
+            if row is None:
+                return MISSING
+            # access times are updated in batches
+            self.__accessed[hashed] = time.time()
+        log.debug('reading cache of %s from %s', key, self.__filepath)
+        return CacheEntry(Compressed(row[4], row[0], bool(row[5])), row[1], row[2], row[3])
+
+    def put(self, key: str, value: Any, etag: Optional[str] = None,
+            last_modified: Optional[str] = None) -> CacheEntry:
+        data, raw_size = Compressed.dump(value, self.__codec)
+        now = time.time()
+        with self.__lock:
+            log.debug('writing cache of %s to %s', key, self.__filepath)
+            self.__conn.execute('INSERT OR REPLACE INTO entries (hash, key, value, size, created, accessed, etag, '
+                                'last_modified, validated, codec, pickled, raw_size) '
+                                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                (hash_key(key), key, data.blob, len(data.blob), now, now, etag, last_modified, now,
+                                 data.codec, int(data.pickled), raw_size))
+            self.__written()
+        return CacheEntry(data, etag, last_modified, now)
+
+    def touch(self, key: str) -> None:
+        now = time.time()
+        with self.__lock:
+            self.__conn.execute('UPDATE entries SET validated = ?, accessed = ? WHERE hash = ?',
+                                (now, now, hash_key(key)))
+            self.__written()
+
+    def remove(self, key: str) -> bool:
+        with self.__lock:
+            cursor = self.__conn.execute('DELETE FROM entries WHERE hash = ?', (hash_key(key),))
+            self.__written()
+            return cursor.rowcount > 0
+
+    def compression(self) -> dict:
+        """
+        @return: total sizes of entries before and after compressed
+        """
+        with self.__lock:
+            raw, size = self.__conn.execute('SELECT COALESCE(SUM(COALESCE(raw_size, size)), 0), '
+                                            'COALESCE(SUM(size), 0) FROM entries').fetchone()
+        return {'raw': raw, 'size': size, 'ratio': round(raw / size, 2) if size > 0 else None}
+
+    def usage(self) -> Tuple[int, int]:
+        """
+        @return: count of entries and their total size in bytes
+        """
+        with self.__lock:
+            count, size = self.__conn.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries').fetchone()
+        return count, size
+
+    def access_times(self) -> List[Tuple[float, int]]:
+        """
+        @return: access time and size of every entry
+        """
+        with self.__lock:
+            self.flush()
+            return self.__conn.execute('SELECT accessed, size FROM entries').fetchall()
+
+    def items(self, limit: Optional[int] = None) -> List[Tuple[str, Any]]:
+        """
+        @return: keys and values of the most recently created entries
+        """
+        with self.__lock:
+            rows = self.__conn.execute('SELECT key, value, COALESCE(codec, \'identity\'), COALESCE(pickled, 1) '
+                                       'FROM entries ORDER BY created DESC LIMIT ?',
+                                       (-1 if limit is None else limit,)).fetchall()
+        return [(row[0], Compressed(row[2], row[1], bool(row[3])).load()) for row in rows]
+
+    def evict(self, max_bytes: Optional[int] = None, max_age: Optional[timedelta] = None,
+              accessed_before: Optional[float] = None) -> int:
+        """
+        Removes entries accessed too long ago, then least recently used entries beyond the quota.
+        @param max_bytes: max total size of entries
+        @param max_age: max age of entries since last accessed
+        @param accessed_before: remove entries accessed before the timestamp
+        @return: size of removed entries in bytes
+        """
+        if max_age is not None:
+            cutoff = time.time() - max_age.total_seconds()
+            accessed_before = cutoff if accessed_before is None else max(accessed_before, cutoff)
+        removed = 0
+        with self.__lock:
+            self.flush()
+            if accessed_before is not None:
+                removed += self.__conn.execute('SELECT COALESCE(SUM(size), 0) FROM entries WHERE accessed < ?',
+                                               (accessed_before,)).fetchone()[0]
+                self.__conn.execute('DELETE FROM entries WHERE accessed < ?', (accessed_before,))
+            if max_bytes is not None:
+                total, hashes = 0, []
+                for hashed, size in self.__conn.execute('SELECT hash, size FROM entries ORDER BY accessed DESC'):
+                    total += size
+                    if total > max_bytes:
+                        hashes.append((hashed,))
+                        removed += size
+                self.__conn.executemany('DELETE FROM entries WHERE hash = ?', hashes)
+            self.flush()
+        if removed > 0:
+            log.info('Evicted %d bytes from %s', removed, self.__filepath)
+        return removed
+
+    def vacuum(self) -> int:
+        """
+        Rebuilds the database file to release free pages.
+        @return: size of released disk space in bytes
+        """
+        with self.__lock:
+            self.flush()
+            before = self.__disk_size()
+            self.__conn.execute('VACUUM')
+            self.__conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+            return max(before - self.__disk_size(), 0)
+
+    def flush(self) -> None:
+        with self.__lock:
+            if len(self.__accessed) > 0:
+                self.__conn.executemany('UPDATE entries SET accessed = ? WHERE hash = ?',
+                                        [(v, k) for k, v in self.__accessed.items()])
+                self.__accessed.clear()
+            self.__conn.commit()
+            self.__pending = 0
+            self.__committed_at = time.monotonic()
+
+    def close(self) -> None:
+        with self.__lock:
+            self.flush()
+            self.__conn.close()
+
+    def __disk_size(self):
+        return sum(os.path.getsize(self.__filepath + x) for x in ['', '-wal'] if os.path.exists(self.__filepath + x))
+
+    def __written(self):
+        self.__pending += 1
+        if self.__pending >= self.__batch_size or time.monotonic() - self.__committed_at >= self.__batch_interval:
+            self.flush()
+
+
+class MemoryCache:
+    """
+    Thread-safe LRU cache bounded by the estimated size of values in bytes.
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.__max_bytes = max_bytes
+        self.__entries: OrderedDict = OrderedDict()
+        self.__size = 0
+        self.__lock = threading.Lock()
+        self.__hits = self.__misses = self.__evictions = 0
+
+    @property
+    def max_bytes(self):
+        return self.__max_bytes
+
+    @max_bytes.setter
+    def max_bytes(self, max_bytes):
+        with self.__lock:
+            self.__max_bytes = max_bytes
+            self.__shrink()
+
+    def get(self, key) -> Any:
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is None:
+                self.__misses += 1
+                return MISSING
+            self.__entries.move_to_end(key)
+            self.__hits += 1
+            return entry[0]
+
+    def put(self, key, value) -> None:
+        size = sizeof(value)
+        with self.__lock:
+            self.__discard(key)
+            if size > self.__max_bytes:
+                return
+            self.__entries[key] = (value, size)
+            self.__size += size
+            self.__shrink()
+
+    def remove(self, key) -> None:
+        with self.__lock:
+            self.__discard(key)
+
+    def clear(self) -> None:
+        with self.__lock:
+            self.__entries.clear()
+            self.__size = 0
+
+    def stats(self) -> dict:
+        with self.__lock:
+            return {
+                'hits': self.__hits,
+                'misses': self.__misses,
+                'evictions': self.__evictions,
+                'count': len(self.__entries),
+                'bytes': self.__size
+            }
+
+    def __discard(self, key):
+        entry = self.__entries.pop(key, None)
+        if entry is not None:
+            self.__size -= entry[1]
+
+    def __shrink(self):
+        while self.__size > self.__max_bytes:
+            key, (value, size) = self.__entries.popitem(last=False)
+            self.__size -= size
+            self.__evictions += 1
+
+
+class TieredStore(CacheStore):
+    """
+    Store with a memory tier in front of the disk store.
+    """
+
+    def __init__(self, disk: SqliteStore, memory: MemoryCache):
+        self.__disk = disk
+        self.__memory = memory
+
+    @property
+    def disk(self):
+        return self.__disk
+
+    def get_entry(self, key: str) -> Any:
+        entry = self.__memory.get((self.__disk.filepath, key))
+        if entry is MISSING:
+            entry = self.__disk.get_entry(key)
+            if entry is not MISSING:
+                # keep the loaded value in memory, so hits are neither decompressed nor unpickled again
+                entry = entry._replace(data=entry.value)
+                self.__memory.put((self.__disk.filepath, key), entry)
+        return entry
+
+    def put(self, key: str, value: Any, etag: Optional[str] = None,
+            last_modified: Optional[str] = None) -> CacheEntry:
+        entry = self.__disk.put(key, value, etag, last_modified)._replace(data=value)
+        self.__memory.put((self.__disk.filepath, key), entry)
+        return entry
+
+    def touch(self, key: str) -> None:
+        self.__disk.touch(key)
+        entry = self.__memory.get((self.__disk.filepath, key))
+        if entry is not MISSING:
+            self.__memory.put((self.__disk.filepath, key), entry._replace(validated=time.time()))
+
+    def remove(self, key: str) -> bool:
+        self.__memory.remove((self.__disk.filepath, key))
+        return self.__disk.remove(key)
+
+    def flush(self) -> None:
+        self.__disk.flush()
+
+
+def sizeof(value) -> int:
+    """
+    Estimates the size of the cached value in bytes.
+    """
+    if isinstance(value, CacheEntry):
+        value = value.data
+    if isinstance(value, Compressed):
+        return sys.getsizeof(value.blob) + 64
+    content = getattr(value, 'content', None)
+    if isinstance(content, bytes):
+        # responses
+        return sys.getsizeof(content) + 1024
+    return sys.getsizeof(value)
+
+
+def hash_key(key: str) -> str:
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def cache_key(path: str, query: str = None) -> str:
+    """
+    Generates the key of a request, compatible with paths of the legacy pickle files.
+    """
+    key = path if not query else path + '?' + query
+    return key.rstrip('/')
+
+
+memory_cache = MemoryCache()
+_stores: Dict[str, SqliteStore] = {}
+_stores_lock = threading.Lock()
+
+
+def open_store(cache_dir) -> SqliteStore:
+    """
+    Opens the store under the directory, shared by all callers in the process.
+    """
+    filepath = os.path.abspath(os.path.join(cache_dir, 'cache.db'))
+    with _stores_lock:
+        if filepath not in _stores:
+            _stores[filepath] = SqliteStore(filepath)
+        return _stores[filepath]
+
+
+def open_cache(cache_dir) -> TieredStore:
+    """
+    Opens the store under the directory with the process-wide memory tier in front.
+    """
+    return TieredStore(open_store(cache_dir), memory_cache)
+
+
+@atexit.register
+def close_stores():
+    with _stores_lock:
+        for store in _stores.values():
+            store.close()
+        _stores.clear()
+
+
+def find_stores(root) -> Dict[str, SqliteStore]:
+    """
+    Finds stores in cache directories of sites under the root, keyed by names of the directories.
+    """
+    stores = {}
+    for name in os.listdir(root):
+        if os.path.isfile(os.path.join(root, name, 'cache.db')):
+            stores[name] = open_store(os.path.join(root, name))
+    return stores
+
+
+def compact_caches(root, max_bytes: Optional[int] = None, host_max_bytes: Optional[int] = None,
+                   host_quotas: Optional[Dict[str, int]] = None, max_age: Optional[timedelta] = None) -> Dict[str, int]:
+    """
+    Evicts entries of all caches under the root, then releases the disk space.
+    @param root: parent directory of cache directories of sites, TEMP by default
+    @param max_bytes: max total size of all caches
+    @param host_max_bytes: max size of the cache of every host, unless specified in host_quotas
+    @param host_quotas: max sizes of caches of specific hosts
+    @param max_age: max age of entries since last accessed
+    @return: size of evicted entries as 'evicted' and disk space released by vacuuming as 'released', in bytes,
+    not to be added up since the released space consists of evicted entries
+    """
+    stores, host_quotas = find_stores(root), host_quotas or {}
+    reclaimed = 0
+    for hostname, store in stores.items():
+        reclaimed += store.evict(host_quotas.get(hostname, host_max_bytes), max_age)
+
+    if max_bytes is not None:
+        # least recently used entries of all hosts go first
+        entries = sorted([x for store in stores.values() for x in store.access_times()], reverse=True)
+        total, cutoff = 0, None
+        for accessed, size in entries:
+            total += size
+            if total > max_bytes:
+                cutoff = accessed
+                break
+        if cutoff is not None:
+            for store in stores.values():
+                reclaimed += store.evict(accessed_before=cutoff + 1e-6)
+
+    released = sum(store.vacuum() for store in stores.values())
+    log.info('Evicted %d bytes of entries and released %d bytes of disk from %d caches', reclaimed, released,
+             len(stores))
+    return {'evicted': reclaimed, 'released': released}
+
+
+def start_compaction(root, interval=timedelta(hours=1), **kwargs) -> threading.Thread:
+    """
+    Compacts caches under the root periodically in a daemon thread.
+    @param kwargs: quotas passed to compact_caches()
+    """
+
+    def run():
+        while True:
+            try:
+                compact_caches(root, **kwargs)
+            except Exception as ex:
+                log.error('Fail to compact caches under %s: %s', root, ex)
+            time.sleep(interval.total_seconds())
+
+    thread = threading.Thread(target=run, name='cache-compaction', daemon=True)
+    thread.start()
+    return thread
+
+
+def compression_stats(root) -> Dict[str, dict]:
+    """
+    @return: compression of caches under the root, keyed by hosts
+    """
+    return dict((hostname, store.compression()) for hostname, store in find_stores(root).items())
+
+
+def parse_size(size: str) -> int:
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+    size = size.strip().upper().rstrip('B')
+    if size[-1:] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+
+def import_pickles(cache_dir, remove=False) -> Tuple[int, int]:
+    """
+    Imports legacy pickle files under the directory into the store of the directory.
+    @param remove: whether to remove the pickle files after imported
+    @return: count of imported files and their total size in bytes
+    """
+    store = open_store(cache_dir)
+    count, size = 0, 0
+    for dirpath, dirnames, filenames in os.walk(cache_dir):
+        for filename in filenames:
+            if not filename.endswith('.pkl'):
+                continue
+            filepath = os.path.join(dirpath, filename)
+            key = '/' + os.path.relpath(filepath, cache_dir)[:-len('.pkl')].replace(os.sep, '/')
+            key = key.replace(f'#{ord("?")}', '?')
+            try:
+                with open(filepath, 'rb') as fp:
+                    value = pickle.load(fp)
+            except (pickle.UnpicklingError, EOFError) as ex:
+                log.error('cannot import %s: %s', filepath, ex)
+                continue
+            store.put(key, value)
+            count += 1
+            size += os.path.getsize(filepath)
+            if remove:
+                os.remove(filepath)
+    store.flush()
+    if remove:
+        for dirpath, dirnames, filenames in os.walk(cache_dir, topdown=False):
+            if dirpath != cache_dir and len(os.listdir(dirpath)) == 0:
+                os.rmdir(dirpath)
+    log.info('Imported %d pickle files (%d bytes) into %s', count, size, store.filepath)
+    return count, size
+
+
+def read_kwargs() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Manage caches of sites.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    importing = commands.add_parser('import', help='import legacy pickle files into the store')
+    importing.add_argument('cache_dir', nargs='+', help='specify cache directories of sites')
+    importing.add_argument('-r', '--remove', action='store_true', help='remove pickle files after imported')
+    compacting = commands.add_parser('compact', help='evict entries and release disk space of caches')
+    compacting.add_argument('-r', '--root', default=os.getenv('TEMP'), help='specify the parent directory of caches')
+    compacting.add_argument('-s', '--max-size', type=parse_size, help='specify the total quota, like 2G')
+    compacting.add_argument('--host-max-size', type=parse_size, help='specify the quota of every host, like 200M')
+    compacting.add_argument('-q', '--quota', action='append', default=[],
+                            help='specify the quota of a host, like www.example.com=500M')
+    compacting.add_argument('-a', '--max-age', type=int, help='specify max days since entries were last accessed')
+    stats = commands.add_parser('stats', help='show the compression of caches')
+    stats.add_argument('-r', '--root', default=os.getenv('TEMP'), help='specify the parent directory of caches')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = read_kwargs()
+    if args.command == 'import':
+        for directory in args.cache_dir:
+            import_pickles(directory, args.remove)
+    elif args.command == 'compact':
+        quotas = dict((x.split('=')[0].strip(), parse_size(x.split('=')[1])) for x in args.quota)
+        max_days = None if args.max_age is None else timedelta(days=args.max_age)
+        compact_caches(args.root, args.max_size, args.host_max_size, quotas, max_days)
+    elif args.command == 'stats':
+        for host, compression in compression_stats(args.root).items():
+            print('%-32s %12d %12d %8s' % (host, compression['raw'], compression['size'], compression['ratio']))
@@ -5,8 +5,10 @@ Crawls data from douban.com
 
 @Author Kingen
 """
+import math
 
 from internet import BaseSite
+from internet.parallel import paginate
 
 
 class Douban(BaseSite):
@@ -15,13 +17,16 @@ class Douban(BaseSite):
         super().__init__('https://movie.douban.com')
 
     def movie_top250(self, start=0):
-        items = []
-        while True:
-            page = self.__get_items('/top250', start)
-            items += page['items']
-            start += page['count']
-            if start >= page['total']:
-                return items
+        size = 0
+
+        def fetch_page(index):
+            nonlocal size
+            page = self.__get_items('/top250', start + index * size)
+            # the first page is fetched alone
+            size = size or page['count']
+            return (math.ceil((page['total'] - start) / size) if size > 0 else 1), page['items']
+
+        return [x for items in paginate(fetch_page, 0) for x in items]
 
     def __get_items(self, path: str, start=0):
         soup = self.get_soup(path, params={'start': start})
@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+"""
+Declarative specs to extract fields from pages.
+
+Selectors are compiled once when the spec is defined, and all fields are extracted in a single pass over the tree:
+
+    spec = Extractor(
+        title=Field('.heading'),
+        actors=Field('[itemprop="actor"]', many=True),
+        cover=Field('.cover img', attr='src')
+    )
+    work = spec.extract(soup)
+
+@Author Kingen
+"""
+import re
+from collections import defaultdict
+from typing import Any, Callable, Dict, List, Optional
+
+import soupsieve
+from bs4 import Tag
+
+attribute_regexp = re.compile('\\[\\s*([\\w-]*)[^]]*]')
+arguments_regexp = re.compile('\\([^)]*\\)')
+
+
+def hint_of(selector: str) -> Optional[str]:
+    """
+    Finds a cheap requirement of elements matching the selector from its last compound selector,
+    like '#id', '.class', '[attr' or the tag name.
+    @return: the requirement, or None if not found
+    """
+    if ',' in selector:
+        return None
+    simplified = arguments_regexp.sub('()', attribute_regexp.sub('[\\1]', selector.strip()))
+    compound = re.split('[\\s>+~]+', simplified)[-1]
+    for regexp, prefix in [('#([\\w-]+)', '#'), ('\\.([\\w-]+)', '.'), ('\\[([\\w-]+)]', '['), ('^([\\w-]+)', '')]:
+        match = re.search(regexp, compound)
+        if match:
+            return prefix + match.group(1)
+    return None
+
+
+def text_of(tag: Tag) -> str:
+    return tag.text.strip()
+
+
+def not_blank(value: Optional[str]) -> Optional[str]:
+    return value if value is not None and len(value.strip()) > 0 else None
+
+
+class Field:
+    """
+    A field extracted from the first element matching the selector, or from every one if many.
+    """
+
+    def __init__(self, selector: str, attr: Optional[str] = None, many=False,
+                 getter: Callable[[Tag], Any] = text_of, transform: Optional[Callable[[Any], Any]] = None,
+                 default=None, namespaces=None):
+        """
+        @param attr: read the attribute of the element instead of its stripped text
+        @param many: extract a list of values of all matching elements
+        @param getter: function to read the raw value of the element if attr is not specified
+        @param transform: function to convert a present raw value
+        @param default: value if no element matches or the transformed value is None
+        """
+        self.__selector = soupsieve.compile(selector, namespaces)
+        self.__hint = hint_of(selector)
+        self.__attr = attr
+        self.__many = many
+        self.__getter = getter
+        self.__transform = transform
+        self.__default = default
+
+    @property
+    def hint(self):
+        return self.__hint
+
+    @property
+    def many(self):
+        return self.__many
+
+    @property
+    def default(self):
+        return [] if self.__many and self.__default is None else self.__default
+
+    def match(self, tag: Tag) -> bool:
+        return self.__selector.match(tag)
+
+    def read(self, tag: Tag) -> Any:
+        value = self.__getter(tag) if self.__attr is None else tag.get(self.__attr)
+        if value is not None and self.__transform is not None:
+            value = self.__transform(value)
+        return value
+
+
+class Extractor:
+    """
+    Extracts fields from a tree in one pass.
+    Fields are indexed by hints of their selectors, so an element is only matched against fields it may satisfy,
+    and single fields stop matching once found.
+    """
+
+    def __init__(self, scope: Optional[str] = None, **fields: Field):
+        """
+        @param scope: selector of the container to extract fields from, the whole tree if not specified
+        """
+        self.__scope = None if scope is None else soupsieve.compile(scope)
+        self.__fields = fields
+        self.__hinted: Dict[str, List[str]] = defaultdict(list)
+        self.__unhinted: List[str] = []
+        for name, field in fields.items():
+            if field.hint is None:
+                self.__unhinted.append(name)
+            else:
+                self.__hinted[field.hint].append(name)
+
+    def extract(self, soup: Tag) -> Optional[Dict[str, Any]]:
+        """
+        @return: values of fields, or None if the scope is not found
+        """
+        root = soup if self.__scope is None else self.__scope.select_one(soup)
+        if root is None:
+            return None
+        values: Dict[str, Any] = dict((name, []) for name, field in self.__fields.items() if field.many)
+        # stop early only if all fields are single
+        pending = len(self.__fields) if len(values) == 0 else -1
+        for tag in root.descendants:
+            if not isinstance(tag, Tag):
+                continue
+            for name in self.__candidates(tag):
+                field = self.__fields[name]
+                if field.many:
+                    if field.match(tag):
+                        values[name].append(field.read(tag))
+                elif name not in values and field.match(tag):
+                    values[name] = field.read(tag)
+                    pending -= 1
+            if pending == 0:
+                break
+        for name, field in self.__fields.items():
+            value = values.get(name)
+            if value is None or (field.many and len(value) == 0):
+                values[name] = field.default
+        return values
+
+    def __candidates(self, tag: Tag) -> List[str]:
+        candidates = list(self.__unhinted)
+        hinted = self.__hinted
+        if tag.name in hinted:
+            candidates.extend(hinted[tag.name])
+        for attr, value in tag.attrs.items():
+            key = '[' + attr
+            if key in hinted:
+                candidates.extend(hinted[key])
+            if attr == 'id':
+                key = '#' + value
+                if key in hinted:
+                    candidates.extend(hinted[key])
+            elif attr == 'class':
+                for cls in (value.split() if isinstance(value, str) else value):
+                    key = '.' + cls
+                    if key in hinted:
+                        candidates.extend(hinted[key])
+        return candidates
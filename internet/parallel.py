@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+"""
+Helpers to run requests concurrently.
+
+@Author Kingen
+"""
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, Hashable, Iterator, List, Optional, Tuple
+
+import common
+
+log = common.get_logger()
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls with the same key, so only the first one is executed and the others wait for
+    and share its result or exception.
+    """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__calls: Dict[Hashable, Future] = {}
+        self.__executed = 0
+        self.__saved = 0
+
+    def do(self, key: Hashable, func: Callable[[], Any]) -> Any:
+        with self.__lock:
+            call = self.__calls.get(key)
+            leading = call is None
+            if leading:
+                self.__executed += 1
+                call = self.__calls[key] = Future()
+            else:
+                self.__saved += 1
+        if not leading:
+            log.debug('Waiting for the call in flight: %s', key)
+            return call.result()
+
+        try:
+            result = func()
+        except BaseException as ex:
+            call.set_exception(ex)
+            raise
+        else:
+            call.set_result(result)
+            return result
+        finally:
+            with self.__lock:
+                del self.__calls[key]
+
+    def stats(self) -> dict:
+        with self.__lock:
+            return {'executed': self.__executed, 'saved': self.__saved, 'inFlight': len(self.__calls)}
+
+
+flights = SingleFlight()
+
+
+class Scheduler:
+    """
+    Runs tasks by a bounded count of threads, higher priority first.
+    Tasks of the same host are limited separately, so a free worker picks the next task whose host has room.
+    """
+
+    def __init__(self, workers=4, host_limit=1, host_limits: Dict[str, int] = None):
+        """
+        @param workers: max count of tasks running at once
+        @param host_limit: max count of running tasks of every host
+        @param host_limits: max count of running tasks of specific hosts
+        """
+        self.__workers = workers
+        self.__host_limit = host_limit
+        self.__host_limits = host_limits or {}
+        self.__cond = threading.Condition()
+        self.__pending: List[Tuple[int, int, str, Optional[str], Callable[[], Any]]] = []
+        self.__running: Dict[str, int] = {}
+        self.__results: List[dict] = []
+        self.__submitted = 0
+        self.__interrupt: Optional[BaseException] = None
+
+    def submit(self, name: str, func: Callable[[], Any], host: Optional[str] = None, priority=0) -> None:
+        """
+        Submits a task. Tasks of the same priority are run in the order of submitting.
+        """
+        with self.__cond:
+            self.__submitted += 1
+            self.__pending.append((-priority, self.__submitted, name, host, func))
+            self.__pending.sort(key=lambda x: x[:2])
+
+    def run(self) -> List[dict]:
+        """
+        Runs all submitted tasks and waits for them. If a task is interrupted, like by KeyboardInterrupt,
+        tasks not started are dropped and the interrupt is raised once running ones finish.
+        @return: name, host, wall time in seconds, result and error of every task, in the order of finishing
+        """
+        threads = [threading.Thread(target=self.__work, name=f'scheduler-{i}') for i in range(self.__workers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if self.__interrupt is not None:
+            raise self.__interrupt
+        return self.__results
+
+    def __work(self):
+        while True:
+            task = self.__next_task()
+            if task is None:
+                return
+            _, _, name, host, func = task
+            result, error, start = None, None, time.monotonic()
+            try:
+                result = func()
+            except Exception as ex:
+                log.error('Fail to run %s: %s', name, ex)
+                error = ex
+            except BaseException as ex:
+                # pending tasks are dropped and the interrupt is raised by run()
+                error = ex
+                with self.__cond:
+                    self.__interrupt = ex
+                    self.__pending.clear()
+                return
+            finally:
+                with self.__cond:
+                    if host is not None:
+                        self.__running[host] -= 1
+                    self.__results.append({
+                        'name': name,
+                        'host': host,
+                        'wallTime': round(time.monotonic() - start, 3),
+                        'result': result,
+                        'error': error
+                    })
+                    self.__cond.notify_all()
+
+    def __next_task(self):
+        with self.__cond:
+            while len(self.__pending) > 0:
+                for i, task in enumerate(self.__pending):
+                    host = task[3]
+                    if host is None or self.__running.get(host, 0) < self.__host_limits.get(host, self.__host_limit):
+                        del self.__pending[i]
+                        if host is not None:
+                            self.__running[host] = self.__running.get(host, 0) + 1
+                        return task
+                self.__cond.wait()
+            return None
+
+
+def paginate(fetch_page: Callable[[int], Tuple[int, list]], first=1, workers=4,
+             stop: Callable[[list], bool] = None, head: Optional[Tuple[int, list]] = None) -> Iterator[list]:
+    """
+    Fetches the first page alone to learn the count of pages, then fetches the remaining ones by a bounded count of
+    threads, keeping at most workers pages in flight.
+    @param fetch_page: function returning the index after the last page and records of the page of the given index
+    @param first: index of the first page
+    @param stop: predicate on records of a page, to stop fetching pages after it
+    @param head: result of the first page if fetched already
+    @return: records of every page, in the order of pages
+    """
+    end, records = head if head is not None else fetch_page(first)
+    yield records
+    if stop is not None and stop(records):
+        return
+    pages = iter(range(first + 1, end))
+    with ThreadPoolExecutor(workers, thread_name_prefix='paginate') as executor:
+        pending: deque = deque(executor.submit(fetch_page, page) for _, page in zip(range(workers), pages))
+        try:
+            while len(pending) > 0:
+                _, records = pending.popleft().result()
+                yield records
+                if stop is not None and stop(records):
+                    return
+                page = next(pages, None)
+                if page is not None:
+                    pending.append(executor.submit(fetch_page, page))
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+def prefetch(fetch_page: Callable[[int], Any], has_next: Callable[[Any], bool], first=1, depth=1,
+             head: Any = None) -> Iterator[Any]:
+    """
+    Fetches pages of a paginator whose end is only known from the current page, requesting the following depth pages
+    while the current one is consumed. Pages prefetched after the end, or after the consumer stops, are cancelled or
+    discarded, along with their errors.
+    @param fetch_page: function returning the page of the given index
+    @param has_next: predicate on a page whether there are pages after it
+    @param first: index of the first page
+    @param head: the first page if fetched already
+    @return: pages in order
+    """
+    with ThreadPoolExecutor(depth + 1, thread_name_prefix='prefetch') as executor:
+        pending: deque = deque()
+        if head is not None:
+            pending.append(Future())
+            pending[0].set_result(head)
+        pending.extend(executor.submit(fetch_page, page) for page in range(first + len(pending), first + depth + 1))
+        index = first + depth + 1
+        try:
+            while True:
+                page = pending.popleft().result()
+                if not has_next(page):
+                    yield page
+                    return
+                pending.append(executor.submit(fetch_page, index))
+                index += 1
+                yield page
+        finally:
+            for future in pending:
+                future.cancel()
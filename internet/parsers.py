@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+"""
+Backends to parse HTML.
+
+@Author Kingen
+"""
+import argparse
+import functools
+import re
+import time
+from typing import Dict, List, Iterable, Union, Tuple
+
+from bs4 import BeautifulSoup, SoupStrainer
+from bs4.builder import builder_registry
+
+import common
+
+log = common.get_logger()
+
+default_parser = 'html.parser'
+known_parsers = ['html.parser', 'lxml', 'html5lib']
+_resolved: Dict[str, str] = {}
+simple_selector_regexp = re.compile('(?P<tag>[\\w-]+)?(?:#(?P<id>[\\w-]+))?(?P<classes>(?:\\.[\\w-]+)*)')
+Fragment = Union[str, List[str], Tuple[str, ...]]
+
+
+def resolve_parser(parser: str = None) -> str:
+    """
+    Resolves the tree builder of BeautifulSoup, falling back to the default one if not installed.
+    """
+    parser = parser or default_parser
+    if parser not in _resolved:
+        if builder_registry.lookup(parser) is None:
+            log.warning('Parser %s is not installed, use %s instead', parser, default_parser)
+            _resolved[parser] = default_parser
+        else:
+            _resolved[parser] = parser
+    return _resolved[parser]
+
+
+def available_parsers() -> List[str]:
+    return [x for x in known_parsers if builder_registry.lookup(x) is not None]
+
+
+class AnyStrainer(SoupStrainer):
+    """
+    Keeps tags matching any of the strainers.
+    """
+
+    def __init__(self, strainers: List[SoupStrainer]):
+        super().__init__()
+        self.__strainers = strainers
+
+    def allow_tag_creation(self, nsprefix, name, attrs) -> bool:
+        return any(x.allow_tag_creation(nsprefix, name, attrs) for x in self.__strainers)
+
+    def allow_string_creation(self, string) -> bool:
+        return False
+
+    def __repr__(self):
+        return '<AnyStrainer %s>' % self.__strainers
+
+
+def _has_classes(classes):
+    return lambda value: value is not None and classes.issubset(value.split())
+
+
+@functools.lru_cache(maxsize=None)
+def _compile_selector(selector: str) -> SoupStrainer:
+    match = simple_selector_regexp.fullmatch(selector.strip())
+    if match is None or selector.strip() == '':
+        raise ValueError('Not a simple selector: ' + selector)
+    attrs = {}
+    if match['id'] is not None:
+        attrs['id'] = match['id']
+    if match['classes']:
+        attrs['class'] = _has_classes(frozenset(match['classes'].split('.')[1:]))
+    return SoupStrainer(match['tag'], attrs)
+
+
+def compile_fragment(fragment: Fragment) -> SoupStrainer:
+    """
+    Compiles simple selectors like 'div.movie-info' or '#videos_head' to a strainer.
+    @param fragment: a selector, or a list of selectors to keep tags matching any of them
+    """
+    if isinstance(fragment, str):
+        return _compile_selector(fragment)
+    if len(fragment) == 1:
+        return _compile_selector(fragment[0])
+    return AnyStrainer([_compile_selector(x) for x in fragment])
+
+
+def make_soup(markup, parser: str = None, fragment: Fragment = None) -> BeautifulSoup:
+    """
+    Parses the markup with the backend. All backends share the select/select_one surface of BeautifulSoup.
+    @param fragment: simple selectors of containers to parse, the other parts of the document are dropped.
+        Selectors of the soup are supposed to stay within the containers. Not supported by html5lib.
+    """
+    if fragment is None:
+        return BeautifulSoup(markup, resolve_parser(parser))
+    return BeautifulSoup(markup, resolve_parser(parser), parse_only=compile_fragment(fragment))
+
+
+def benchmark_parsers(pages: Iterable[str], parsers: List[str] = None, rounds=1) -> Dict[str, dict]:
+    """
+    Compares the time to parse the pages by every backend.
+    @return: count of pages, total seconds and milliseconds per page of every backend
+    """
+    pages = list(pages)
+    results = {}
+    for parser in parsers or available_parsers():
+        start = time.perf_counter()
+        for _ in range(rounds):
+            for page in pages:
+                BeautifulSoup(page, parser)
+        elapsed = time.perf_counter() - start
+        count = len(pages) * rounds
+        results[parser] = {
+            'pages': count,
+            'seconds': round(elapsed, 3),
+            'msPerPage': round(elapsed * 1000 / count, 3) if count > 0 else None
+        }
+    return results
+
+
+def read_kwargs() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Benchmark parsers on cached pages of a site.')
+    parser.add_argument('cache_dir', help='specify the cache directory of the site')
+    parser.add_argument('-e', '--encoding', default='utf-8', help='specify the encoding of pages')
+    parser.add_argument('-n', '--limit', type=int, default=200, help='specify max count of pages')
+    parser.add_argument('-r', '--rounds', type=int, default=1, help='specify rounds to parse every page')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    from internet.cache import open_store
+
+    args = read_kwargs()
+    html_pages = []
+    for key, value in open_store(args.cache_dir).items(args.limit * 4):
+        if isinstance(value, bytes):
+            value = value.decode(args.encoding, errors='ignore')
+        if isinstance(value, str) and value.lstrip()[:1] == '<':
+            html_pages.append(value)
+        if len(html_pages) >= args.limit:
+            break
+    for name, result in benchmark_parsers(html_pages, rounds=args.rounds).items():
+        print('%-12s %6d pages %10.3f s %10.3f ms/page' % (name, result['pages'], result['seconds'],
+                                                         result['msPerPage'] or 0))
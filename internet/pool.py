@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+"""
+Shared pools of HTTP connections.
+
+@Author Kingen
+"""
+import threading
+import time
+from typing import Dict, Tuple, Optional
+
+from requests import Session
+from requests.adapters import HTTPAdapter
+from urllib3.util import parse_url
+
+import common
+
+log = common.get_logger()
+
+
+class PooledAdapter(HTTPAdapter):
+    """
+    Adapter whose keep-alive connections are shared by all sessions mounting it.
+    Idle connections are dropped once the adapter has not been used for max_idle seconds.
+    """
+
+    def __init__(self, pool_size=10, max_idle: Optional[float] = 60.0):
+        super().__init__(pool_connections=1, pool_maxsize=pool_size)
+        self.__max_idle = max_idle
+        self.__lock = threading.Lock()
+        self.__last_used = time.monotonic()
+        self.__in_flight = 0
+        self.__requests = 0
+        self.__connections = 0
+
+    def send(self, request, **kwargs):
+        with self.__lock:
+            now = time.monotonic()
+            if self.__max_idle is not None and self.__in_flight == 0 and now - self.__last_used > self.__max_idle:
+                log.debug('Dropping idle connections to %s', parse_url(request.url).host)
+                self.__collect()
+                self.poolmanager.clear()
+            self.__last_used = now
+            self.__in_flight += 1
+        try:
+            return super().send(request, **kwargs)
+        finally:
+            with self.__lock:
+                self.__in_flight -= 1
+                self.__last_used = time.monotonic()
+
+    def stats(self) -> dict:
+        with self.__lock:
+            requests, connections = self.__requests, self.__connections
+            for key in self.poolmanager.pools.keys():
+                pool = self.poolmanager.pools[key]
+                requests += pool.num_requests
+                connections += pool.num_connections
+        return {
+            'requests': requests,
+            'connections': connections,
+            'reused': max(requests - connections, 0)
+        }
+
+    def __collect(self):
+        for key in self.poolmanager.pools.keys():
+            pool = self.poolmanager.pools[key]
+            self.__requests += pool.num_requests
+            self.__connections += pool.num_connections
+
+
+class PoolRegistry:
+    """
+    Process-wide registry of adapters keyed by scheme and host.
+    """
+
+    def __init__(self, pool_size=10, max_idle: Optional[float] = 60.0):
+        self.__pool_size = pool_size
+        self.__max_idle = max_idle
+        self.__adapters: Dict[Tuple[str, str], PooledAdapter] = {}
+        self.__lock = threading.Lock()
+
+    def configure(self, pool_size=None, max_idle: Optional[float] = -1):
+        """
+        Configures pools created afterwards.
+        @param pool_size: max count of connections kept for a host
+        @param max_idle: seconds to keep idle connections alive, None to keep them forever
+        """
+        if pool_size is not None:
+            self.__pool_size = pool_size
+        if max_idle is None or max_idle >= 0:
+            self.__max_idle = max_idle
+
+    def adapter(self, url) -> PooledAdapter:
+        url = parse_url(url)
+        key = (url.scheme, url.netloc)
+        with self.__lock:
+            if key not in self.__adapters:
+                self.__adapters[key] = PooledAdapter(self.__pool_size, self.__max_idle)
+            return self.__adapters[key]
+
+    def mount(self, session: Session, url) -> Session:
+        """
+        Lets the session borrow connections of the host of the url from the shared pool.
+        """
+        url = parse_url(url)
+        session.mount('%s://%s/' % (url.scheme, url.netloc), self.adapter(url.url))
+        return session
+
+    def stats(self) -> Dict[str, dict]:
+        with self.__lock:
+            adapters = list(self.__adapters.items())
+        return dict(('%s://%s' % key, adapter.stats()) for key, adapter in adapters)
+
+    def close(self):
+        with self.__lock:
+            for adapter in self.__adapters.values():
+                adapter.close()
+            self.__adapters.clear()
+
+
+pools = PoolRegistry()
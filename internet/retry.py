@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+"""
+Policies to retry failed requests.
+
+@Author Kingen
+"""
+import random
+import threading
+import time
+from typing import Callable, Dict, Iterable, Optional, Tuple, Type
+
+from requests import Response
+from requests.exceptions import ConnectionError, Timeout, ChunkedEncodingError
+
+import common
+
+log = common.get_logger()
+
+
+class RetryPolicy:
+    """
+    Retries requests on given status codes or exceptions with exponential backoff and jitter.
+    Retrying time of every host is capped in total, so one broken host fails fast after a while.
+    """
+
+    def __init__(self, statuses: Iterable[int] = (429, 500, 502, 503, 504),
+                 exceptions: Tuple[Type[Exception], ...] = (ConnectionError, Timeout, ChunkedEncodingError),
+                 methods: Iterable[str] = ('GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS'),
+                 max_attempts=4, backoff=1.0, max_backoff=30.0, jitter=0.5, max_retry_time: Optional[float] = 300.0):
+        """
+        @param statuses: status codes of responses to retry
+        @param exceptions: classes of exceptions to retry
+        @param methods: idempotent methods to retry
+        @param max_attempts: max count of attempts of a request, including the first one
+        @param backoff: seconds to wait before the first retry, doubled for every next retry
+        @param max_backoff: max seconds to wait before a retry
+        @param jitter: ratio of the waiting time to randomize
+        @param max_retry_time: max seconds spent on retrying for every host, None if unlimited
+        """
+        self.__statuses = frozenset(statuses)
+        self.__exceptions = exceptions
+        self.__methods = frozenset(x.upper() for x in methods)
+        self.__max_attempts = max_attempts
+        self.__backoff = backoff
+        self.__max_backoff = max_backoff
+        self.__jitter = jitter
+        self.__max_retry_time = max_retry_time
+        self.__stats: Dict[str, dict] = {}
+        self.__lock = threading.Lock()
+
+    def run(self, hostname: str, func: Callable[[], Response], method='GET') -> Response:
+        """
+        Calls the function until it succeeds or no retry is allowed.
+        @return: the last response
+        """
+        attempt = 0
+        while True:
+            attempt += 1
+            self.__count(hostname, 'attempts')
+            try:
+                response = func()
+            except self.__exceptions as ex:
+                delay = self.__next_delay(hostname, method, attempt, None)
+                if delay is None:
+                    self.__count(hostname, 'failures')
+                    raise
+                log.warning('Retrying %s in %.2fs after attempt %d: %s', hostname, delay, attempt, ex)
+            else:
+                if response.status_code not in self.__statuses:
+                    return response
+                delay = self.__next_delay(hostname, method, attempt, response)
+                if delay is None:
+                    self.__count(hostname, 'failures')
+                    return response
+                log.warning('Retrying %s in %.2fs after attempt %d: status %d', hostname, delay, attempt,
+                            response.status_code)
+                response.close()
+            time.sleep(delay)
+
+    def stats(self) -> Dict[str, dict]:
+        with self.__lock:
+            return dict((k, v.copy()) for k, v in self.__stats.items())
+
+    def __next_delay(self, hostname, method, attempt, response: Optional[Response]) -> Optional[float]:
+        if method.upper() not in self.__methods or attempt >= self.__max_attempts:
+            return None
+        delay = min(self.__max_backoff, self.__backoff * 2 ** (attempt - 1))
+        delay *= 1 - self.__jitter * random.random()
+        retry_after = None if response is None else response.headers.get('Retry-After')
+        if retry_after is not None and retry_after.isdigit():
+            delay = max(delay, min(float(retry_after), self.__max_backoff))
+        with self.__lock:
+            stats = self.__host_stats(hostname)
+            if self.__max_retry_time is not None and stats['retryTime'] + delay > self.__max_retry_time:
+                log.error('Retrying time of %s is used up', hostname)
+                return None
+            stats['retries'] += 1
+            stats['retryTime'] = round(stats['retryTime'] + delay, 3)
+        return delay
+
+    def __count(self, hostname, key):
+        with self.__lock:
+            self.__host_stats(hostname)[key] += 1
+
+    def __host_stats(self, hostname) -> dict:
+        if hostname not in self.__stats:
+            self.__stats[hostname] = {'attempts': 0, 'retries': 0, 'failures': 0, 'retryTime': 0.0}
+        return self.__stats[hostname]
+
+
+default_retry_policy = RetryPolicy()
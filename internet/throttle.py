@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+"""
+Rate limits of requests.
+
+@Author Kingen
+"""
+import threading
+import time
+from typing import Dict, Callable
+
+import common
+
+log = common.get_logger()
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket. Tokens are reserved in order of arrival, so callers wait in turn.
+    """
+
+    def __init__(self, rate: float, burst=1, clock: Callable[[], float] = time.monotonic):
+        """
+        @param rate: tokens added per second
+        @param burst: max count of tokens kept in the bucket
+        @param clock: monotonic clock shared by all callers
+        """
+        if rate <= 0 or burst < 1:
+            raise ValueError('rate must be positive and burst must be at least 1')
+        self.__rate = rate
+        self.__burst = burst
+        self.__clock = clock
+        self.__tokens = float(burst)
+        self.__updated = clock()
+        self.__lock = threading.Lock()
+        self.__acquired = 0
+        self.__waited = 0.0
+
+    @property
+    def rate(self):
+        return self.__rate
+
+    @property
+    def burst(self):
+        return self.__burst
+
+    def reserve(self) -> float:
+        """
+        Takes a token, going in debt if none is left.
+        @return: seconds to wait before the token is usable
+        """
+        with self.__lock:
+            now = self.__clock()
+            self.__tokens = min(self.__burst, self.__tokens + (now - self.__updated) * self.__rate)
+            self.__updated = now
+            self.__tokens -= 1
+            wait = 0.0 if self.__tokens >= 0 else -self.__tokens / self.__rate
+            self.__acquired += 1
+            self.__waited += wait
+            return wait
+
+    def acquire(self) -> float:
+        """
+        Blocks until a token is available.
+        @return: seconds waited
+        """
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def stats(self) -> dict:
+        with self.__lock:
+            return {
+                'rate': self.__rate,
+                'burst': self.__burst,
+                'acquired': self.__acquired,
+                'waited': round(self.__waited, 3)
+            }
+
+
+class RateLimiter:
+    """
+    Registry of token buckets keyed by host. Hosts without a configured bucket are not limited.
+    """
+
+    def __init__(self, clock: Callable[[], float] = time.monotonic):
+        self.__clock = clock
+        self.__buckets: Dict[str, TokenBucket] = {}
+        self.__lock = threading.Lock()
+
+    def configure(self, hostname: str, rate: float, burst=1):
+        """
+        Limits requests to the host.
+        @param hostname: name of the host
+        @param rate: requests per second
+        @param burst: max count of requests sent at once
+        """
+        with self.__lock:
+            self.__buckets[hostname] = TokenBucket(rate, burst, self.__clock)
+
+    def remove(self, hostname: str):
+        with self.__lock:
+            self.__buckets.pop(hostname, None)
+
+    def acquire(self, hostname: str) -> float:
+        """
+        Blocks until a request to the host is allowed.
+        @return: seconds waited
+        """
+        bucket = self.__buckets.get(hostname)
+        if bucket is None:
+            return 0.0
+        waited = bucket.acquire()
+        if waited > 0:
+            log.debug('Waited %.3fs for the rate limit of %s', waited, hostname)
+        return waited
+
+    def stats(self) -> Dict[str, dict]:
+        with self.__lock:
+            buckets = list(self.__buckets.items())
+        return dict((hostname, bucket.stats()) for hostname, bucket in buckets)
+
+
+rate_limiter = RateLimiter()
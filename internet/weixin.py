@@ -47,12 +47,12 @@ class WeixinApi(BaseSite):
             self.__expires_at = datetime.now() + timedelta(seconds=body['expires_in'])
         return self.__access_token
 
-    def _do_get(self, path, params=None):
+    def _do_get_response(self, path, params=None, headers=None):
         if params is None:
             params = {}
         if path != '/cgi-bin/token':
             params['access_token'] = self.__get_access_token()
-        return super()._do_get(path, params)
+        return super()._do_get_response(path, params, headers)
 
     def _do_request(self, path, method='POST', query=None, **kwargs) -> Response:
         if query is None:
@@ -71,7 +71,7 @@ class WeixinApi(BaseSite):
         body = super().post_json(path, query, cache, retry, **kwargs)
         return self.__handle_error(body)
 
-    def get_json(self, path, params=None, cache=False, retry=False):
+    def get_json(self, path, params=None, cache=None, retry=False):
         body = super().get_json(path, params, cache, retry)
         return self.__handle_error(body)
 